@@ -0,0 +1,261 @@
+import os
+import mmap
+import time
+import struct
+from collections.abc import Mapping
+from nvram import NVRAM_Codec, as_bytes
+
+class NVRAM_ArchiveIndex(Mapping):
+    """The memory-mapped sidecar index of an archived backup, a mapping of
+    { key: (offset, length), ... }. Entries are stored in the order of the
+    backup and preceded by a table of their positions sorted by key, so a
+    key is found with a binary search without loading the index.
+    """
+    count_struct = struct.Struct('<I')
+    position_struct = struct.Struct('<I')
+
+    def __init__(self, path, header, entry_struct):
+        """:path: Path to the index, as written by `NVRAM_Archive.write_index`
+        :header: The header the index must start with
+        :entry_struct: The `struct.Struct` of the (offset, length) of every value
+        """
+        self.entry_struct = entry_struct
+        with open(path, 'rb') as index_file:
+            self.map = mmap.mmap(index_file.fileno(), 0, access = mmap.ACCESS_READ)
+        if self.map[:len(header)] != header or len(self.map) < len(header) + self.count_struct.size:
+            self.map.close()
+            raise IOError("{} is not a valid backup index".format(repr(path)))
+        self.count = self.count_struct.unpack_from(self.map, len(header))[0]
+        self.positions = len(header) + self.count_struct.size
+        self.entries = self.positions + self.count * self.position_struct.size
+
+    def key_at(self, position):
+        return self.map[position + 1 : position + 1 + self.map[position]]
+
+    def find(self, key):
+        """Returns the position of the entry of *key*, `None` if it isn't indexed"""
+        low, high = 0, self.count
+        unpack_position = self.position_struct.unpack_from
+        while low < high:
+            middle = (low + high) // 2
+            position = unpack_position(self.map, self.positions + middle * self.position_struct.size)[0]
+            found = self.key_at(position)
+            if found == key:
+                return position
+            if found < key:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def __getitem__(self, key):
+        position = self.find(as_bytes(key))
+        if position is None:
+            raise KeyError(key)
+        return self.entry_struct.unpack_from(self.map, position + 1 + self.map[position])
+
+    def __contains__(self, key):
+        return self.find(as_bytes(key)) is not None
+
+    def __iter__(self):
+        position = self.entries
+        while position < len(self.map):
+            key = self.key_at(position)
+            yield key
+            position += 1 + len(key) + self.entry_struct.size
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.map.close()
+
+class NVRAM_ArchivedBackup(Mapping):
+    """A read-only view of a backup stored in an `NVRAM_Archive`. The
+    backup is memory-mapped and looked up through its sidecar index, so
+    reading a key only touches the pages holding its value.
+    """
+    def __init__(self, backup_path, index):
+        """:backup_path: Path to the raw nvram backup
+        :index: A mapping of { key: (offset, length), ... } for the backup,
+        usually an `NVRAM_ArchiveIndex`, it's closed along with the backup
+        """
+        self.path = backup_path
+        self.index = index
+        with open(backup_path, 'rb') as backup:
+            self.map = mmap.mmap(backup.fileno(), 0, access = mmap.ACCESS_READ)
+
+    def __getitem__(self, key):
+        offset, length = self.index[as_bytes(key)]
+        return self.map[offset : offset + length]
+
+    def __contains__(self, key):
+        return as_bytes(key) in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def raw(self):
+        """Returns the whole backup, ready to be decoded or uploaded as a restore"""
+        return self.map[:]
+
+    def close(self):
+        self.map.close()
+        if hasattr(self.index, 'close'):
+            self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class NVRAM_Archive:
+    """Stores nvram backups of many routers on disk, in the DD-WRT binary
+    format, along with a sidecar index of every key so single values can
+    be read without decoding the whole backup. The layout is:
+
+        {root}/{host}/{timestamp}.bkp    the backup as returned by `NVRAM.backup`
+        {root}/{host}/{timestamp}.idx    the index of the backup
+
+    where timestamp is an integer number of seconds since the epoch.
+    """
+    backup_extension = '.bkp'
+    index_extension = '.idx'
+    index_header = b'DDIDX2'
+    index_entry_struct = struct.Struct('<IH')
+
+    def __init__(self, root, codec = None):
+        """:root: The directory holding the archive, it's created if needed
+        :codec: The `NVRAM_Codec` used to index the backups
+        """
+        self.root = root
+        self.codec = NVRAM_Codec() if codec is None else codec
+        os.makedirs(root, exist_ok = True)
+
+    def store(self, host, backup, timestamp = None):
+        """Stores the raw *backup* of *host* taken at *timestamp* (now if
+        it's `None`), returns the timestamp it was stored as. Raises
+        `FileExistsError` if *host* already has a backup at that timestamp
+        """
+        timestamp = self.to_timestamp(time.time() if timestamp is None else timestamp)
+        index = self.build_index(backup)
+        os.makedirs(self.host_path(host), exist_ok = True)
+        backup_path, index_path = self.paths(host, timestamp)
+        with open(backup_path, 'xb') as backup_file:
+            backup_file.write(backup)
+        self.write_index(index_path, index)
+        return timestamp
+
+    def open(self, host, timestamp):
+        """Returns an `NVRAM_ArchivedBackup` for the backup of *host*
+        taken at *timestamp*, the index is rebuilt if it's missing
+        """
+        backup_path, index_path = self.paths(host, self.to_timestamp(timestamp))
+        if not os.path.exists(index_path):
+            with open(backup_path, 'rb') as backup_file:
+                self.write_index(index_path, self.build_index(backup_file.read()))
+        return NVRAM_ArchivedBackup(backup_path, self.read_index(index_path))
+
+    def hosts(self):
+        """Returns a sorted list of the hosts stored in the archive"""
+        return sorted(entry for entry in os.listdir(self.root)
+                      if os.path.isdir(os.path.join(self.root, entry)))
+
+    def timestamps(self, host):
+        """Returns a sorted list of the timestamps of every backup of
+        *host*, files that aren't named after a timestamp are ignored
+        """
+        try:
+            entries = os.listdir(self.host_path(host))
+        except FileNotFoundError:
+            return []
+        stems = (entry[:-len(self.backup_extension)] for entry in entries
+                 if entry.endswith(self.backup_extension))
+        return sorted(int(stem) for stem in stems if stem.isdigit())
+
+    def latest(self, host, when = None):
+        """Returns the timestamp of the newest backup of *host* taken at or
+        before *when* (a timestamp or a `datetime`), `None` if there isn't any
+        """
+        timestamps = self.timestamps(host)
+        if when is not None:
+            when = self.to_timestamp(when)
+            timestamps = [timestamp for timestamp in timestamps if timestamp <= when]
+        return timestamps[-1] if timestamps else None
+
+    def lookup(self, host, key, when = None, default = None):
+        """Returns the value *key* had on *host* at *when* (see `.latest`),
+        or *default* if there's no backup or the key wasn't set
+        """
+        timestamp = self.latest(host, when)
+        if timestamp is None:
+            return default
+        with self.open(host, timestamp) as backup:
+            return backup.get(key, default)
+
+    def iter_key(self, key, hosts = None):
+        """Yields `(host, timestamp, value)` for every archived backup of
+        *hosts* (all of them if `None`), *value* is `None` if the key wasn't
+        set. Only the index and the pages holding the value are read
+        """
+        for host in (self.hosts() if hosts is None else hosts):
+            for timestamp in self.timestamps(host):
+                with self.open(host, timestamp) as backup:
+                    yield host, timestamp, backup.get(key)
+
+    def build_index(self, backup):
+        """Returns { key: (offset, length), ... } for the raw *backup*"""
+        index = {}
+        with memoryview(backup) as view:
+            self.codec.check_header(view)
+            for key_start, key_end, value_start, value_end in self.codec.iter_offsets(view):
+                index[view[key_start : key_end].tobytes()] = (value_start, value_end - value_start)
+            self.codec.check_items(view, len(index))
+        return index
+
+    def write_index(self, path, index):
+        """Writes the { key: (offset, length), ... } *index* to *path*: the
+        header, the number of entries, the position of every entry sorted
+        by key and then the entries in the order of *index*
+        """
+        position_size = NVRAM_ArchiveIndex.position_struct.size
+        position = len(self.index_header) + NVRAM_ArchiveIndex.count_struct.size + len(index) * position_size
+        positions = {}
+        entries = bytearray()
+        for key, (offset, length) in index.items():
+            positions[key] = position + len(entries)
+            entries += self.codec.key_size_struct.pack(len(key))
+            entries += key
+            entries += self.index_entry_struct.pack(offset, length)
+        with open(path, 'wb') as index_file:
+            index_file.write(self.index_header)
+            index_file.write(NVRAM_ArchiveIndex.count_struct.pack(len(index)))
+            index_file.write(b''.join(NVRAM_ArchiveIndex.position_struct.pack(positions[key])
+                                      for key in sorted(positions)))
+            index_file.write(entries)
+
+    def read_index(self, path):
+        """Returns the `NVRAM_ArchiveIndex` stored at *path*"""
+        return NVRAM_ArchiveIndex(path, self.index_header, self.index_entry_struct)
+
+    def host_path(self, host):
+        """Returns the directory of *host*, raises `ValueError` if *host*
+        isn't a plain name that stays inside the archive
+        """
+        separators = [separator for separator in (os.sep, os.altsep, '/') if separator]
+        if host in ('', '.', '..') or any(separator in host for separator in separators):
+            raise ValueError("{} is not a valid host name for the archive".format(repr(host)))
+        return os.path.join(self.root, host)
+
+    def paths(self, host, timestamp):
+        base = os.path.join(self.host_path(host), str(timestamp))
+        return base + self.backup_extension, base + self.index_extension
+
+    def to_timestamp(self, when):
+        if hasattr(when, 'timestamp'):
+            when = when.timestamp()
+        return int(when)
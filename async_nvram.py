@@ -0,0 +1,132 @@
+import asyncio
+from functools import partial
+from ssh import ddwrt_ssh
+from nvram import NVRAM
+
+class async_ddwrt_ssh():
+    """An asyncio front end for `ddwrt_ssh`, the blocking paramiko calls
+    are run in an executor so many routers can be managed concurrently
+    from a single event loop. Calls made on the same router are limited
+    by *max_concurrent*, the total number of blocking calls in flight is
+    limited by the size of the executor.
+    """
+    def __init__(self, router, max_concurrent = None, executor = None):
+        """:router: A `ddwrt_ssh` instance
+        :max_concurrent: How many calls can run at the same time on this
+        router, defaults to the router's `max_channels`
+        :executor: The `concurrent.futures.Executor` used to run the
+        blocking calls, `None` for the event loop's default one. Managing
+        thousands of routers at once needs a thread pool sized accordingly
+        """
+        self.router = router
+        self.executor = executor
+        self.limit = asyncio.Semaphore(router.max_channels if max_concurrent is None else max_concurrent)
+
+    @classmethod
+    async def connect(cls, hostname, max_concurrent = None, executor = None, persistent_shell = False, 
+                      missing_host_key_policy = None, **connect_kwargs):
+        """Opens a paramiko connection to *hostname* without blocking the
+        event loop, *connect_kwargs* are passed to `SSHClient.connect`. The
+        host key must be in the system's known hosts unless a looser 
+        *missing_host_key_policy* is given, `RejectPolicy` by default
+        """
+        import paramiko
+        def connect():
+            client = paramiko.client.SSHClient()
+            client.load_system_host_keys()
+            client.set_missing_host_key_policy(missing_host_key_policy or paramiko.client.RejectPolicy())
+            client.connect(hostname, **connect_kwargs)
+            return ddwrt_ssh(client, persistent_shell = persistent_shell)
+        router = await asyncio.get_running_loop().run_in_executor(executor, connect)
+        return cls(router, max_concurrent, executor)
+
+    async def call(self, func, *args, **kwargs):
+        """Runs the blocking `func(*args, **kwargs)` in the executor, once
+        there's a free slot for this router
+        """
+        async with self.limit:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, partial(func, *args, **kwargs))
+
+    async def run(self, command, check = False, timeout = None):
+        """See `ddwrt_ssh.run`"""
+        return await self.call(self.router.run, command, check, timeout)
+
+    async def run_many(self, commands, check = False, timeout = None):
+        """See `ddwrt_ssh.run_many`"""
+        return await self.call(self.router.run_many, list(commands), check, timeout)
+
+    def close(self):
+        self.router.close_shell()
+        self.router.client.close()
+
+class AsyncNVRAM():
+    """An asyncio version of `NVRAM` with the same methods. While cache
+    mode is active reads and writes are local, so they return right away
+    """
+    def __init__(self, async_router):
+        """:async_router: An `async_ddwrt_ssh` instance"""
+        self.router = async_router
+        self.nvram = NVRAM(async_router.router)
+
+    @property
+    def cache_mode(self):
+        return self.nvram.cache_mode
+
+    @property
+    def cache(self):
+        return self.nvram.cache
+
+    async def call(self, func, *args, **kwargs):
+        """Runs `func(nvram, *args, **kwargs)` in the executor, where `nvram`
+        is the blocking `NVRAM` instance. Useful to run things like
+        `ddwrt_leases.from_nvram` without blocking the event loop
+        """
+        return await self.router.call(func, self.nvram, *args, **kwargs)
+
+    async def set(self, key, value):
+        if self.nvram.cache_mode:
+            return self.nvram.set(key, value)
+        return await self.router.call(self.nvram.set, key, value)
+
+    async def unset(self, key):
+        if self.nvram.cache_mode:
+            return self.nvram.unset(key)
+        return await self.router.call(self.nvram.unset, key)
+
+    async def get(self, key):
+        if self.nvram.cache_mode:
+            return self.nvram.get(key)
+        return await self.router.call(self.nvram.get, key)
+
+    async def get_many(self, keys):
+        if self.nvram.cache_mode:
+            return self.nvram.get_many(keys)
+        return await self.router.call(self.nvram.get_many, list(keys))
+
+    async def get_all(self):
+        return await self.router.call(self.nvram.get_all)
+
+    async def get_snapshot(self):
+        return await self.router.call(self.nvram.get_snapshot)
+
+    async def commit(self):
+        return await self.router.call(self.nvram.commit)
+
+    async def backup(self):
+        return await self.router.call(self.nvram.backup)
+
+    async def restore(self, snapshot):
+        return await self.router.call(self.nvram.restore, snapshot)
+
+    async def enter_cache_mode(self, fetch_all = True):
+        return await self.router.call(self.nvram.enter_cache_mode, fetch_all)
+
+    async def exit_cache_mode(self, as_changeset = True, compare_and_swap = False, commit = False):
+        return await self.router.call(self.nvram.exit_cache_mode, as_changeset, compare_and_swap, commit)
+    
+    def discard_cache_mode(self):
+        return self.nvram.discard_cache_mode()
+    
+    async def apply_if_unchanged(self, sets, unsets, bases, commit = False):
+        return await self.router.call(self.nvram.apply_if_unchanged, sets, unsets, bases, commit)
@@ -0,0 +1,168 @@
+import sys
+import json
+import time
+import argparse
+import platform
+from collections import OrderedDict
+from nvram import NVRAM, NVRAM_Codec, NVRAM_Cache
+from leases import ddwrt_leases, LeaseTable
+from port_forwarding import ddwrt_forwards, ForwardTable
+from simulator import SimulatedRouter
+from ssh import ddwrt_ssh
+
+default_sizes = (1024, 4096, 16384, 65535)
+"""The number of keys benchmarked, a backup can't hold more than 65535"""
+
+def synthetic_nvram(count):
+    """Returns an nvram dictionary of *count* keys with values of mixed sizes"""
+    return OrderedDict((("key_{:06d}".format(index)).encode(),
+                        ("value_{}".format(index) * (1 + index % 8)).encode()) for index in range(count))
+
+def synthetic_leases(count):
+    return "".join("{:012X}=host{}={}.{}.{}.{}= ".format(
+        0x001122000000 + index, index, 10, index >> 16 & 255, index >> 8 & 255, index & 255) for index in range(count))
+
+def synthetic_forwards(count):
+    return " ".join("fwd{}:on:{}:{}>192.168.{}.{}:{}".format(
+        index, ("tcp", "udp", "both")[index % 3], 1024 + index, index >> 8 & 255, index & 255, 2048 + index)
+        for index in range(count))
+
+def measure(func, repeat = 5, number = 1):
+    """Calls *func* *number* times per run, *repeat* runs, returns the
+    per call `{"best": seconds, "median": seconds, "runs": repeat}`
+    """
+    timings = []
+    for run in range(repeat):
+        start = time.perf_counter()
+        for call in range(number):
+            func()
+        timings.append((time.perf_counter() - start) / number)
+    timings.sort()
+    return {"best": timings[0], "median": timings[len(timings) // 2], "runs": repeat}
+
+def codec_cases(sizes):
+    codec = NVRAM_Codec()
+    for size in sizes:
+        nvram = synthetic_nvram(size)
+        backup = codec.encode(nvram)
+        yield "codec.decode[{}]".format(size), lambda backup = backup: codec.decode(backup)
+        yield "codec.encode[{}]".format(size), lambda nvram = nvram: codec.encode(nvram)
+
+def cache_cases(sizes):
+    for size in sizes:
+        cache = NVRAM_Cache(synthetic_nvram(size))
+        for index in range(0, size, 4):
+            cache.set("key_{:06d}".format(index), "changed")
+        for index in range(1, size, 16):
+            cache.unset("key_{:06d}".format(index))
+        yield "cache.get_snapshot[{}]".format(size), cache.get_snapshot
+        yield "cache.get_changes[{}]".format(size), cache.get_changes
+
+def table_cases(sizes):
+    for size in sizes:
+        leases_string = synthetic_leases(size)
+        leases = ddwrt_leases(leases_string)
+        lease_table = LeaseTable.from_static_leases(leases_string)
+        forwards_string = synthetic_forwards(size)
+        forwards = ddwrt_forwards(forwards_string)
+        forward_table = ForwardTable.from_forward_spec(forwards_string)
+        yield "leases.parse[{}]".format(size), lambda string = leases_string: ddwrt_leases(string)
+        yield "leases.serialize[{}]".format(size), leases.__str__
+        yield "lease_table.parse[{}]".format(size), lambda string = leases_string: LeaseTable.from_static_leases(string)
+        yield "lease_table.serialize[{}]".format(size), lease_table.__str__
+        yield "forwards.parse[{}]".format(size), lambda string = forwards_string: ddwrt_forwards(string)
+        yield "forwards.serialize[{}]".format(size), forwards.__str__
+        yield "forward_table.parse[{}]".format(size), lambda string = forwards_string: ForwardTable.from_forward_spec(string)
+        yield "forward_table.serialize[{}]".format(size), forward_table.__str__
+
+def router_cases(size, latency, bandwidth):
+    """End to end `NVRAM` operations against a `SimulatedRouter` holding
+    *size* keys, every round trip takes *latency* seconds
+    """
+    for persistent_shell in (False, True):
+        router = SimulatedRouter(synthetic_nvram(size), latency, bandwidth,
+                                 hostname = "bench-{}".format(persistent_shell))
+        nvram = NVRAM(ddwrt_ssh(router.client(), persistent_shell = persistent_shell))
+        suffix = "[shell]" if persistent_shell else "[exec]"
+        keys = ["key_{:06d}".format(index) for index in range(0, size, max(1, size // 32))]
+        changes = {"key_{:06d}".format(index): "changed" for index in range(0, size, max(1, size // 100))}
+
+        def cache_mode(nvram = nvram, changes = changes):
+            nvram.enter_cache_mode()
+            for key, value in changes.items():
+                nvram.set(key, value)
+            nvram.exit_cache_mode()
+
+        yield "nvram.get" + suffix, lambda nvram = nvram, key = keys[0]: nvram.get(key)
+        yield "nvram.get_many" + suffix, lambda nvram = nvram, keys = keys: nvram.get_many(keys)
+        yield "nvram.set" + suffix, lambda nvram = nvram, key = keys[0]: nvram.set(key, "value")
+        yield "nvram.push_changeset" + suffix, lambda nvram = nvram, changes = changes: nvram.push_changeset(changes, [])
+        yield "nvram.get_all" + suffix, nvram.get_all
+        yield "nvram.cache_mode" + suffix, cache_mode
+
+def run_benchmarks(sizes = default_sizes, router_size = 2048, latency = 0.005,
+                   bandwidth = None, repeat = 5, pattern = None):
+    """Runs every benchmark whose name contains *pattern* (all if `None`),
+    returns { name: measurement, ... } (see `measure`)
+    """
+    cases = [codec_cases(sizes), cache_cases(sizes), table_cases([size for size in sizes if size <= 16384]),
+             router_cases(router_size, latency, bandwidth)]
+    results = OrderedDict()
+    for generator in cases:
+        for name, func in generator:
+            if pattern is None or pattern in name:
+                results[name] = measure(func, repeat)
+    return results
+
+def compare_results(results, baseline, threshold = 0.2, statistic = "best"):
+    """Compares *results* to *baseline* (both { name: measurement, ... }),
+    returns a list of `(name, baseline_seconds, seconds, ratio)` for every
+    benchmark that got slower by more than *threshold* (0.2 being 20%).
+    Benchmarks missing from either side are ignored
+    """
+    regressions = []
+    for name, measurement in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name][statistic]
+        after = measurement[statistic]
+        ratio = after / before if before else float('inf')
+        if ratio > 1 + threshold:
+            regressions.append((name, before, after, ratio))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmarks the codec, the cache, the tables and "
+                                                   "NVRAM against a simulated router")
+    parser.add_argument("--output", help = "Where to write the results (JSON)")
+    parser.add_argument("--baseline", help = "Results (JSON) of an earlier run to compare against")
+    parser.add_argument("--threshold", type = float, default = 0.2,
+                        help = "Allowed slowdown against the baseline, 0.2 is 20%%")
+    parser.add_argument("--filter", dest = "pattern", help = "Only run the benchmarks whose name contains this")
+    parser.add_argument("--latency", type = float, default = 0.005, help = "Simulated seconds per round trip")
+    parser.add_argument("--bandwidth", type = float, help = "Simulated bytes per second")
+    parser.add_argument("--repeat", type = int, default = 5)
+    parser.add_argument("--quick", action = "store_true", help = "Smaller sizes, for a smoke test")
+    args = parser.parse_args()
+
+    sizes = (256, 1024) if args.quick else default_sizes
+    results = run_benchmarks(sizes, 256 if args.quick else 2048, args.latency,
+                             args.bandwidth, args.repeat, args.pattern)
+    for name, measurement in results.items():
+        print("{:40} {:12.3f} ms {:12.3f} ms".format(name, measurement["best"] * 1000, measurement["median"] * 1000))
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"python": platform.python_version(), "platform": platform.platform(),
+                       "time": time.time(), "results": results}, file, indent = 1)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)["results"]
+        regressions = compare_results(results, baseline, args.threshold)
+        for name, before, after, ratio in regressions:
+            print("REGRESSION {}: {:.3f} ms -> {:.3f} ms ({:+.0%})".format(name, before * 1000, after * 1000, ratio - 1))
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__": main()
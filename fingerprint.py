@@ -0,0 +1,70 @@
+import hashlib
+from nvram import NVRAM_Codec
+
+class NVRAM_Fingerprints:
+    """Remembers the last decoded nvram dictionary of every host along with
+    fingerprints of it, so polling a router whose nvram didn't change
+    doesn't decode (and if possible doesn't transfer) the backup again:
+
+        *   a checksum computed on the router (see `remote_command`), a
+            single small round trip tells whether the backup is needed
+        *   a hash of the raw backup, used when the router can't compute
+            the checksum or it changed, to skip decoding identical backups
+
+    The dictionaries returned are shared between calls, don't modify them.
+    """
+    remote_command = "nvram show 2>/dev/null | md5sum"
+    empty_fingerprint = hashlib.md5(b'').hexdigest().encode()
+    """What md5sum prints when `nvram show` failed and wrote nothing, the
+    exit status of the pipeline being md5sum's"""
+
+    def __init__(self, codec = None, use_remote = True):
+        """:codec: The `NVRAM_Codec` used to decode the backups
+        :use_remote: Ask the router for a checksum before fetching the backup
+        """
+        self.codec = NVRAM_Codec() if codec is None else codec
+        self.use_remote = use_remote
+        self.hosts = {}
+
+    def poll(self, host, nvram):
+        """Returns `(dictionary, changed)` where *dictionary* is the decoded
+        nvram of *host* (reached through the `NVRAM` instance *nvram*) and
+        *changed* is False if it's the same as the last time it was polled
+        """
+        entry = self.hosts.get(host)
+        remote = self.remote_fingerprint(nvram) if self.use_remote else None
+        if entry is not None and remote is not None and entry[0] == remote:
+            return entry[2], False
+        dictionary, changed = self.decode(host, nvram.backup())
+        self.hosts[host] = (remote, ) + self.hosts[host][1:]
+        return dictionary, changed
+
+    def decode(self, host, backup):
+        """Returns `(dictionary, changed)` for the raw *backup* of *host*,
+        the backup is only decoded if its hash changed since the last one
+        """
+        digest = hashlib.sha1(backup).digest()
+        entry = self.hosts.get(host)
+        if entry is not None and entry[1] == digest:
+            return entry[2], False
+        dictionary = self.codec.decode(backup)
+        self.hosts[host] = (None, digest, dictionary)
+        return dictionary, True
+
+    def remote_fingerprint(self, nvram):
+        """Returns the checksum of *nvram* computed on the router, or `None`
+        if it couldn't be computed (including when `nvram show` printed
+        nothing, a real nvram is never empty)
+        """
+        result = nvram.router.run(self.remote_command)
+        fingerprint = result.stdout.split(b' ', 1)[0].strip()
+        if result.status != 0 or len(fingerprint) != 32 or fingerprint == self.empty_fingerprint:
+            return None
+        return fingerprint
+
+    def forget(self, host = None):
+        """Drops what's known about *host*, or about every host if `None`"""
+        if host is None:
+            self.hosts.clear()
+        else:
+            self.hosts.pop(host, None)
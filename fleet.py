@@ -0,0 +1,244 @@
+import time
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from ssh import ddwrt_ssh
+from nvram import NVRAM
+from archive import NVRAM_Archive
+
+class HostResult(namedtuple('HostResult', ['host', 'value', 'error', 'attempts', 'elapsed'])):
+    """The outcome of running a job on a single host, *value* is what the
+    job returned and *error* the exception of the last failed attempt
+    """
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.error is None
+
+def connect_paramiko(host, missing_host_key_policy = None, **connect_kwargs):
+    """Opens a `ddwrt_ssh` to *host* with paramiko, *connect_kwargs* are
+    passed to `SSHClient.connect`. The host key must be in the system's 
+    known hosts unless a looser *missing_host_key_policy* is given, 
+    `RejectPolicy` by default
+    """
+    import paramiko
+    client = paramiko.client.SSHClient()
+    client.load_system_host_keys()
+    client.set_missing_host_key_policy(missing_host_key_policy or paramiko.client.RejectPolicy())
+    client.connect(host, **connect_kwargs)
+    return ddwrt_ssh(client)
+
+def run_on_host(host, connect_kwargs, func, connect, retries, backoff, state = None):
+    """Connects to *host* and runs `func(host, nvram)` on it, retrying with an
+    exponential backoff. *state* is shared with `Fleet.run` so the time 
+    the host started is known and a timed out host isn't attempted again
+    """
+    start = time.time()
+    if state is not None:
+        state.started[host] = start
+    attempts = 0
+    while True:
+        if state is not None and host in state.timed_out:
+            return HostResult(host, None, TimeoutError("{} timed out".format(repr(host))), 
+                              attempts, time.time() - start)
+        attempts += 1
+        router = None
+        try:
+            router = connect(host, **connect_kwargs)
+            if state is not None:
+                state.routers[host] = router
+            value = func(host, NVRAM(router))
+            return HostResult(host, value, None, attempts, time.time() - start)
+        except Exception as error:
+            if attempts > retries or (state is not None and host in state.timed_out):
+                return HostResult(host, None, error, attempts, time.time() - start)
+        finally:
+            if router is not None:
+                if state is not None:
+                    state.routers.pop(host, None)
+                router.close_shell()
+                router.client.close()
+        if state is not None and host in state.timed_out:
+            continue
+        time.sleep(backoff * 2 ** (attempts - 1))
+
+class FleetState():
+    """Bookkeeping shared between `Fleet.run` and its workers, when they
+    run on processes *manager* (a `multiprocessing.Manager`) shares it
+    """
+    def __init__(self, manager = None):
+        self.started = {} if manager is None else manager.dict()
+        self.timed_out = {} if manager is None else manager.dict()
+        self.routers = {}
+
+    def __getstate__(self):
+        return {'started': self.started, 'timed_out': self.timed_out, 'routers': {}}
+
+class Fleet():
+    """Runs the same job over many routers in parallel. Results are
+    streamed back as `HostResult` as soon as every host finishes
+    """
+    def __init__(self, inventory, connect = connect_paramiko, parallelism = 8,
+                 timeout = None, retries = 0, backoff = 1.0, processes = False):
+        """:inventory: A list of hostnames, or a dictionary of
+        { hostname: connect_kwargs, ... }
+        :connect: `connect(host, **connect_kwargs)` returning a `ddwrt_ssh`
+        :parallelism: How many hosts are worked on at the same time
+        :timeout: Seconds a host has to finish once it started (all of its
+        attempts included) before it's reported as a `TimeoutError`, `None`
+        to wait forever. Timed out hosts aren't attempted again
+        :retries: How many times a failed host is retried
+        :backoff: Seconds to wait before the first retry, doubled on each one
+        :processes: Use a process pool instead of threads, the job and
+        *connect* have to be picklable. Timed out hosts are reported but
+        the attempt in progress can't be interrupted in this mode
+        """
+        if isinstance(inventory, dict):
+            self.inventory = inventory
+        else:
+            self.inventory = {host: {} for host in inventory}
+        self.connect = connect
+        self.parallelism = parallelism
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.processes = processes
+
+    def run(self, func):
+        """Runs `func(host, nvram)` on every host, where `nvram` is an 
+        `NVRAM` instance. Yields a `HostResult` per host in completion order.
+        Once a host times out the executor isn't waited for when this
+        returns, so the time taken stays bounded
+        """
+        manager = None
+        if self.processes:
+            manager = multiprocessing.Manager()
+            executor = ProcessPoolExecutor(self.parallelism)
+        else:
+            executor = ThreadPoolExecutor(self.parallelism)
+        state = FleetState(manager)
+        timed_out = False
+        futures = {}
+        try:
+            for host, connect_kwargs in self.inventory.items():
+                future = executor.submit(run_on_host, host, connect_kwargs, func, self.connect,
+                                         self.retries, self.backoff, state)
+                futures[future] = host
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, self.next_deadline(pending, futures, state), FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+                for future in self.expired(pending, futures, state):
+                    timed_out = True
+                    pending.discard(future)
+                    future.cancel()
+                    yield HostResult(futures[future], None, TimeoutError(
+                        "{} didn't finish in {} seconds".format(repr(futures[future]), repr(self.timeout))),
+                        None, self.timeout)
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait = not timed_out)
+            if manager is not None:
+                manager.shutdown()
+
+    def next_deadline(self, pending, futures, state):
+        if self.timeout is None:
+            return None
+        started = [state.started[futures[future]] for future in pending if futures[future] in state.started]
+        if not started:
+            return self.timeout
+        return max(0, min(started) + self.timeout - time.time())
+
+    def expired(self, pending, futures, state):
+        """Returns the futures in *pending* whose host started more than 
+        `timeout` seconds ago, their hosts are flagged so they aren't 
+        attempted again and their connections are closed so the worker
+        threads give up
+        """
+        if self.timeout is None:
+            return []
+        now = time.time()
+        expired = []
+        for future in pending:
+            host = futures[future]
+            started = state.started.get(host)
+            if started is not None and now - started >= self.timeout:
+                expired.append(future)
+                state.timed_out[host] = True
+                router = state.routers.get(host)
+                if router is not None:
+                    router.client.close()
+        return expired
+
+    def run_all(self, func):
+        """Same as `.run`, but returns { host: HostResult, ... } once every
+        host is done
+        """
+        return {result.host: result for result in self.run(func)}
+
+    def backup_all(self, archive):
+        """Backs up every host into *archive* (an `NVRAM_Archive` or the
+        path to one), the backups are validated with `NVRAM_Codec` while
+        they're indexed. Yields a `HostResult` per host whose value is the
+        timestamp the backup was stored as
+        """
+        if not isinstance(archive, NVRAM_Archive):
+            archive = NVRAM_Archive(archive)
+        return self.run(BackupJob(archive))
+
+    def apply_changeset_all(self, sets, unsets = (), commit = False, as_changeset = True,
+                            compare_and_swap = False):
+        """Applies *sets* ({ key: value, ... }) and *unsets* ([key, ...]) to
+        every host through `NVRAM_Cache` (see `NVRAM.exit_cache_mode` for
+        *as_changeset* and *compare_and_swap*), committing afterwards if 
+        *commit* is True. Hosts whose nvram changed while the changes were
+        made fail with `NVRAM_ConflictError`, and are retried like any 
+        other failure
+        """
+        return self.run(ChangesetJob(sets, unsets, commit, as_changeset, compare_and_swap))
+
+    def sync_all(self, desired, unset_missing = False, commit = False):
+        """Makes every host match *desired* pushing only the keys that
+        differ on each one (see `NVRAM.sync`), the value of every 
+        `HostResult` is the `(sets, unsets)` applied to that host
+        """
+        return self.run(SyncJob(desired, unset_missing, commit))
+
+class BackupJob():
+    def __init__(self, archive):
+        self.archive = archive
+
+    def __call__(self, host, nvram):
+        return self.archive.store(host, nvram.backup())
+
+class ChangesetJob():
+    def __init__(self, sets, unsets, commit, as_changeset, compare_and_swap = False):
+        self.sets = sets
+        self.unsets = list(unsets)
+        self.commit = commit
+        self.as_changeset = as_changeset
+        self.compare_and_swap = compare_and_swap
+
+    def __call__(self, host, nvram):
+        nvram.enter_cache_mode(fetch_all = self.as_changeset is not True or self.compare_and_swap)
+        for key, value in self.sets.items():
+            nvram.set(key, value)
+        for key in self.unsets:
+            nvram.unset(key)
+        nvram.exit_cache_mode(self.as_changeset, self.compare_and_swap, self.commit)
+        return len(self.sets) + len(self.unsets)
+
+class SyncJob():
+    def __init__(self, desired, unset_missing, commit):
+        self.desired = desired
+        self.unset_missing = unset_missing
+        self.commit = commit
+
+    def __call__(self, host, nvram):
+        changes = nvram.sync(self.desired, self.unset_missing)
+        if self.commit and (changes[0] or changes[1]):
+            nvram.commit()
+        return changes
@@ -1,8 +1,12 @@
 
-from network_common import MAC_address
-from ipaddress import ip_address
+from network_common import MAC_address, parse_macs, format_macs, parse_ipv4s, format_ipv4s
+from ipaddress import ip_address, IPv4Address
+from array import array
+from collections import namedtuple
 
 class Lease:
+    __slots__ = ('mac', 'ip', 'hostname')
+    
     def __init__(self, mac, hostname, ip):
         self.mac = MAC_address(mac)
         self.ip = ip_address(ip)
@@ -21,43 +25,222 @@ class Lease:
         return "{}(mac = {} hostname = {}, ip = {})".format(
             self.__class__.__name__, repr(self.mac), repr(self.hostname), repr(self.ip))
 
+LeaseConflict = namedtuple('LeaseConflict', ['kind', 'lease', 'existing'])
+"""A lease that couldn't be added, *kind* is 'mac' or 'ip' depending on
+which one was already taken by *existing*"""
+
 class ddwrt_leases:
     """This class wraps around Lease, to provide
     a simple way to convert a static_leases nvram string
     into multiple objects and back into a static_leases string
-    these can be edited by accessing the leases attibute
+    these can be edited by accessing the leases attibute.
+    The leases are indexed by MAC, IP and hostname, use `.add`, `.remove`
+    and `.upsert` to keep the indexes consistent, or call `.reindex` after
+    editing the leases list directly
     """
     def __init__(self, leases_string):
-        self.leases = []
-        for lease in leases_string.split(" "):
-            new_lease = Lease.from_static_leases(lease)
-            if new_lease is not None:
-                self.leases += [new_lease]
+        details = [lease.split("=", 3) for lease in leases_string.split(" ")]
+        details = [lease for lease in details if len(lease) >= 3]
+        macs = parse_macs([lease[0] for lease in details])
+        self.leases = [Lease(mac, lease[1], lease[2]) for mac, lease in zip(macs, details)]
+        self.reindex()
+    
+    def reindex(self):
+        """Rebuilds the indexes from the leases list, when there are 
+        duplicates the first lease is the one indexed
+        """
+        self.by_mac = {}
+        self.by_ip = {}
+        self.by_hostname = {}
+        for lease in self.leases:
+            self.by_mac.setdefault(int(lease.mac), lease)
+            self.by_ip.setdefault(lease.ip, lease)
+            self.by_hostname.setdefault(lease.hostname, lease)
+    
+    def find_by_mac(self, mac):
+        """Returns the lease for *mac* (a string, an int or a `MAC_address`),
+        `None` if there isn't any
+        """
+        return self.by_mac.get(int(MAC_address(mac) if isinstance(mac, str) else mac))
+    
+    def find_by_ip(self, ip):
+        """Returns the lease for *ip*, `None` if there isn't any"""
+        return self.by_ip.get(ip_address(ip))
+    
+    def find_by_hostname(self, hostname):
+        """Returns the lease for *hostname*, `None` if there isn't any"""
+        return self.by_hostname.get(hostname)
+    
+    def find_conflict(self, lease):
+        """Returns a `LeaseConflict` if the MAC or the IP of *lease* is taken
+        by another lease, `None` otherwise
+        """
+        existing = self.by_mac.get(int(lease.mac))
+        if existing is not None and existing is not lease:
+            return LeaseConflict('mac', lease, existing)
+        existing = self.by_ip.get(lease.ip)
+        if existing is not None and existing is not lease:
+            return LeaseConflict('ip', lease, existing)
+        return None
+    
+    def add(self, lease):
+        """Adds *lease*, raises `ValueError` if its MAC or IP are taken"""
+        conflict = self.find_conflict(lease)
+        if conflict is not None:
+            raise ValueError("The {} of {} is already used by {}".format(
+                conflict.kind, repr(lease), repr(conflict.existing)))
+        self.leases.append(lease)
+        self.index(lease)
+    
+    def remove(self, mac):
+        """Removes the lease for *mac* (or the lease itself if a `Lease` is
+        given), raises `KeyError` if there's none
+        """
+        lease = mac if isinstance(mac, Lease) else self.find_by_mac(mac)
+        if lease is None or lease not in self.leases:
+            raise KeyError("There's no lease for {}".format(repr(mac)))
+        self.leases.remove(lease)
+        self.unindex(lease)
+        return lease
+    
+    def upsert(self, lease):
+        """Adds *lease*, or updates the hostname and IP of the lease with the
+        same MAC. Raises `ValueError` if its IP is taken by another lease
+        """
+        existing = self.by_mac.get(int(lease.mac))
+        if existing is None:
+            return self.add(lease)
+        taken = self.by_ip.get(lease.ip)
+        if taken is not None and taken is not existing:
+            raise ValueError("The ip of {} is already used by {}".format(repr(lease), repr(taken)))
+        self.unindex(existing)
+        existing.hostname = lease.hostname
+        existing.ip = lease.ip
+        self.index(existing)
+    
+    def bulk_import(self, leases):
+        """Adds every lease in *leases* in a single pass, leases whose MAC 
+        or IP are already taken (including by an earlier lease of *leases*)
+        are skipped. Returns the list of `LeaseConflict` found
+        """
+        conflicts = []
+        for lease in leases:
+            conflict = self.find_conflict(lease)
+            if conflict is not None:
+                conflicts.append(conflict)
+            else:
+                self.leases.append(lease)
+                self.index(lease)
+        return conflicts
+    
+    def index(self, lease):
+        self.by_mac[int(lease.mac)] = lease
+        self.by_ip[lease.ip] = lease
+        self.by_hostname.setdefault(lease.hostname, lease)
+    
+    def unindex(self, lease):
+        """Drops *lease* from the indexes, the slots it held go to the first
+        other lease sharing its MAC, IP or hostname
+        """
+        for index, key, lease_key in ((self.by_mac, int(lease.mac), lambda other: int(other.mac)),
+                                      (self.by_ip, lease.ip, lambda other: other.ip),
+                                      (self.by_hostname, lease.hostname, lambda other: other.hostname)):
+            if index.get(key) is lease:
+                del index[key]
+                for other in self.leases:
+                    if other is not lease and lease_key(other) == key:
+                        index[key] = other
+                        break
 
     @classmethod
     def from_nvram(cls, nvram, check_entries = True):
-        leases = cls(nvram.get("static_leases").decode("ascii"))
         if check_entries:
-            expected_leases = int(nvram.get("static_leasenum").decode("ascii"))
+            values = nvram.get_many(["static_leases", "static_leasenum"])
+            leases = cls(values["static_leases"].decode("ascii"))
+            expected_leases = int(values["static_leasenum"].decode("ascii"))
             if len(leases) != expected_leases:
                 raise IOError("Expected to parse {} leases, but instead parsed {}".format(
                     repr(expected_leases), repr(len(leases))))
             else:
                 return leases
         else:
-            return leases
+            return cls(nvram.get("static_leases").decode("ascii"))
     
     def write_to_nvram(self, nvram):
         nvram.set("static_leases", str(self))
         nvram.set("static_leasenum", len(self))
 
     def __str__(self):
-        formatted = ""
-        for lease in self.leases:
-            formatted += "{}={}={}= ".format(str(lease.mac), 
-                                             str(lease.hostname), 
-                                             str(lease.ip))
-        return formatted
+        macs = format_macs([int(lease.mac) for lease in self.leases])
+        return "".join(["{}={}={}= ".format(mac, 
+                                            str(lease.hostname), 
+                                            str(lease.ip)) for mac, lease in zip(macs, self.leases)])
     
     def __len__(self):
-        return len(self.leases)
\ No newline at end of file
+        return len(self.leases)
+
+class LeaseTable:
+    """A compact, columnar version of `ddwrt_leases` for sites with lots
+    of static leases. MACs and IPs are stored as integers in arrays and
+    only turned into `Lease` objects when a row is accessed
+    """
+    __slots__ = ('macs', 'hostnames', 'ips')
+    
+    def __init__(self):
+        self.macs = array('Q')
+        self.hostnames = []
+        self.ips = array('I')
+    
+    @classmethod
+    def from_static_leases(cls, leases_string):
+        """Parses a whole static_leases nvram string"""
+        table = cls()
+        macs = []
+        ips = []
+        for lease in leases_string.split(" "):
+            details = lease.split("=", 3)
+            if len(details) >= 3:
+                macs.append(details[0])
+                table.hostnames.append(details[1])
+                ips.append(details[2])
+        table.macs = parse_macs(macs)
+        table.ips = parse_ipv4s(ips)
+        return table
+    
+    @classmethod
+    def from_leases(cls, leases):
+        """Builds a table out of an iterable of `Lease` (or a `ddwrt_leases`)"""
+        if isinstance(leases, ddwrt_leases):
+            leases = leases.leases
+        table = cls()
+        for lease in leases:
+            table.append(lease.mac, lease.hostname, lease.ip)
+        return table
+    
+    def append(self, mac, hostname, ip):
+        self.macs.append(int(MAC_address(mac) if isinstance(mac, str) else mac))
+        self.hostnames.append(hostname)
+        self.ips.append(int(IPv4Address(ip)))
+    
+    def to_leases(self):
+        """Returns a list of `Lease`, one per row"""
+        return [self[row] for row in range(len(self))]
+    
+    def __getitem__(self, row):
+        return Lease(self.macs[row], self.hostnames[row], self.ips[row])
+    
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
+    
+    def __len__(self):
+        return len(self.macs)
+    
+    def write_to_nvram(self, nvram):
+        nvram.set("static_leases", str(self))
+        nvram.set("static_leasenum", len(self))
+    
+    def __str__(self):
+        """Serializes the table back into a static_leases string"""
+        return "".join(["{}={}={}= ".format(mac, hostname, ip) for mac, hostname, ip in 
+                        zip(format_macs(self.macs), self.hostnames, format_ipv4s(self.ips))])
\ No newline at end of file
@@ -0,0 +1,229 @@
+import time
+import inspect
+import threading
+from bisect import bisect_left
+from functools import wraps
+
+def instrumented(event, bytes_in = None, bytes_out = None):
+    """Decorates a method so every call is reported to `self.metrics`, if
+    it's not `None`, as *event* along with how long it took. *bytes_in* and
+    *bytes_out* are `function(result, *args)` returning how many bytes the
+    call received and sent, *args* being the arguments of the call in the
+    order of the method's signature, whether they were given by keyword or
+    not. Generators are timed until they're exhausted and the size of what
+    they yield is counted as bytes in.
+    When `self.metrics` is `None` the only cost is an attribute lookup, and
+    the metrics failing never affects the call
+    """
+    def decorator(method):
+        signature = inspect.signature(method)
+
+        def arguments(self, args, kwargs):
+            bound = signature.bind(self, *args, **kwargs)
+            bound.apply_defaults()
+            return bound.args[1:]
+
+        if inspect.isgeneratorfunction(method):
+            @wraps(method)
+            def wrapper(self, *args, **kwargs):
+                metrics = self.metrics
+                if metrics is None:
+                    yield from method(self, *args, **kwargs)
+                    return
+                start = time.perf_counter()
+                size = 0
+                try:
+                    for chunk in method(self, *args, **kwargs):
+                        size += len(chunk)
+                        yield chunk
+                except Exception:
+                    report(metrics, event, time.perf_counter() - start, lambda: (size, 0), True)
+                    raise
+                report(metrics, event, time.perf_counter() - start, lambda: (size, 0))
+            return wrapper
+
+        def sizes(self, result, args, kwargs):
+            call_args = arguments(self, args, kwargs)
+            return (0 if bytes_in is None else bytes_in(result, *call_args),
+                    0 if bytes_out is None else bytes_out(result, *call_args))
+
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            metrics = self.metrics
+            if metrics is None:
+                return method(self, *args, **kwargs)
+            start = time.perf_counter()
+            try:
+                result = method(self, *args, **kwargs)
+            except Exception:
+                report(metrics, event, time.perf_counter() - start, lambda: (0, 0), True)
+                raise
+            report(metrics, event, time.perf_counter() - start, lambda: sizes(self, result, args, kwargs))
+            return result
+        return wrapper
+    return decorator
+
+def report(metrics, event, seconds, sizes, error = False):
+    """Records a call on *metrics*, *sizes* returns `(bytes_in, bytes_out)`.
+    Anything going wrong while measuring or recording is ignored, a broken
+    sink mustn't fail a call that already succeeded
+    """
+    try:
+        received, sent = sizes()
+        metrics.record(event, seconds, received, sent, error)
+    except Exception:
+        pass
+
+class CallbackSink:
+    """Calls `callback(event, seconds, bytes_in, bytes_out, error)` for every
+    call recorded, from whatever thread made it
+    """
+    def __init__(self, *callbacks):
+        self.callbacks = callbacks
+
+    def record(self, event, seconds, bytes_in = 0, bytes_out = 0, error = False):
+        for callback in self.callbacks:
+            callback(event, seconds, bytes_in, bytes_out, error)
+
+class Histogram:
+    """A latency histogram with fixed bucket bounds (in seconds)"""
+    bounds = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, bounds = None):
+        if bounds is not None:
+            self.bounds = tuple(bounds)
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, seconds):
+        self.buckets[bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, fraction):
+        """Returns the upper bound of the bucket holding the *fraction*
+        quantile, `max` if it falls past the last bound
+        """
+        if not self.count:
+            return None
+        target = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.buckets):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def cumulative(self):
+        """Yields `(bound, count)` for every bucket the way Prometheus
+        expects them, the last bound being `inf`
+        """
+        seen = 0
+        for bound, count in zip(self.bounds + (float('inf'), ), self.buckets):
+            seen += count
+            yield bound, seen
+
+class EventStats:
+    __slots__ = ('latency', 'bytes_in', 'bytes_out', 'errors')
+
+    def __init__(self, bounds = None):
+        self.latency = Histogram(bounds)
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.errors = 0
+
+class AggregateSink:
+    """Keeps in memory the count, latency histogram, bytes in and out and
+    errors of every event. They can be read with `.summary` or exported
+    with `.prometheus` and `.statsd`
+    """
+    def __init__(self, bounds = None):
+        """:bounds: The bucket bounds of the histograms, in seconds"""
+        self.bounds = bounds
+        self.events = {}
+        self.exported = {}
+        self.lock = threading.Lock()
+
+    def record(self, event, seconds, bytes_in = 0, bytes_out = 0, error = False):
+        with self.lock:
+            stats = self.events.get(event)
+            if stats is None:
+                stats = self.events[event] = EventStats(self.bounds)
+            stats.latency.add(seconds)
+            stats.bytes_in += bytes_in
+            stats.bytes_out += bytes_out
+            if error:
+                stats.errors += 1
+
+    def summary(self):
+        """Returns { event: { "count", "errors", "seconds", "min", "max",
+        "p50", "p99", "bytes_in", "bytes_out" }, ... }
+        """
+        with self.lock:
+            return {event: {"count": stats.latency.count,
+                            "errors": stats.errors,
+                            "seconds": stats.latency.sum,
+                            "min": stats.latency.min,
+                            "max": stats.latency.max,
+                            "p50": stats.latency.quantile(0.5),
+                            "p99": stats.latency.quantile(0.99),
+                            "bytes_in": stats.bytes_in,
+                            "bytes_out": stats.bytes_out} for event, stats in self.events.items()}
+
+    def reset(self):
+        with self.lock:
+            self.events.clear()
+            self.exported.clear()
+
+    def prometheus(self, prefix = "ddwrt"):
+        """Returns every event in the Prometheus text exposition format,
+        the event is used as the `event` label. Every metric family is
+        written as a whole right after its TYPE line
+        """
+        seconds, bytes_in, bytes_out, errors = ("{}_{}".format(prefix, family) for family in
+                                                 ("seconds", "bytes_in_total", "bytes_out_total", "errors_total"))
+        histogram = ["# TYPE {} histogram".format(seconds)]
+        counters = (["# TYPE {} counter".format(bytes_in)], ["# TYPE {} counter".format(bytes_out)],
+                    ["# TYPE {} counter".format(errors)])
+        with self.lock:
+            for event, stats in sorted(self.events.items()):
+                label = 'event="{}"'.format(event.replace('\\', '\\\\').replace('"', '\\"'))
+                for bound, count in stats.latency.cumulative():
+                    histogram.append('{}_bucket{{{},le="{}"}} {}'.format(
+                        seconds, label, "+Inf" if bound == float('inf') else repr(bound), count))
+                histogram.append("{}_sum{{{}}} {!r}".format(seconds, label, stats.latency.sum))
+                histogram.append("{}_count{{{}}} {}".format(seconds, label, stats.latency.count))
+                for lines, name, value in zip(counters, (bytes_in, bytes_out, errors),
+                                              (stats.bytes_in, stats.bytes_out, stats.errors)):
+                    lines.append("{}{{{}}} {}".format(name, label, value))
+        return "\n".join(histogram + [line for lines in counters for line in lines]) + "\n"
+
+    def statsd(self, prefix = "ddwrt"):
+        """Returns what every event recorded since the last call as StatsD
+        lines (counters and the mean latency as a timer in milliseconds),
+        ready to be sent over UDP. StatsD adds up counters, so only the
+        increments are sent and nothing is counted twice
+        """
+        lines = []
+        with self.lock:
+            for event, stats in sorted(self.events.items()):
+                name = "{}.{}".format(prefix, event)
+                current = (stats.latency.count, stats.errors, stats.bytes_in, stats.bytes_out, stats.latency.sum)
+                count, errors, bytes_in, bytes_out, seconds = [
+                    now - before for now, before in zip(current, self.exported.get(event, (0, 0, 0, 0, 0.0)))]
+                self.exported[event] = current
+                if not count:
+                    continue
+                lines.append("{}.count:{}|c".format(name, count))
+                lines.append("{}.errors:{}|c".format(name, errors))
+                lines.append("{}.bytes_in:{}|c".format(name, bytes_in))
+                lines.append("{}.bytes_out:{}|c".format(name, bytes_out))
+                lines.append("{}.latency:{:.3f}|ms".format(name, seconds / count * 1000))
+        return "\n".join(lines) + "\n"
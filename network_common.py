@@ -1,5 +1,12 @@
 
+import re
+import sys
+import socket
+from array import array
+
 class MAC_address:
+    __slots__ = ('address', )
+    
     def __init__(self, address):
         if isinstance(address, str):
             self.address = int(address.replace(':', ''), 16)
@@ -10,14 +17,8 @@ class MAC_address:
                 repr(str), repr(int), repr(address.__class__)))
     
     def __str__(self):
-        return "{:02X}:{:02X}:{:02X}:{:02X}:{:02X}:{:02X}".format(
-            (self.address >> 40 & 0xff),
-            (self.address >> 32 & 0xff),
-            (self.address >> 24 & 0xff),
-            (self.address >> 16 & 0xff),
-            (self.address >> 8  & 0xff),
-            (self.address & 0xff)
-            )
+        digits = "{:012X}".format(self.address & 0xffffffffffff)
+        return ":".join((digits[0:2], digits[2:4], digits[4:6], digits[6:8], digits[8:10], digits[10:12]))
     
     def __repr__(self):
         return "{}({})".format(self.__class__.__name__, repr(str(self)))
@@ -26,6 +27,8 @@ class MAC_address:
         return self.address
 
 class State:
+    __slots__ = ('_state', )
+    
     def __init__(self, state):
         self.state = state
         
@@ -61,13 +64,15 @@ class State:
         return self._state
 
 class Port:
+    __slots__ = ('allow_null', '_number')
+    
     def __init__(self, number, allow_null = True):
         self.allow_null = allow_null
         self.port = number
 
     @property
     def port(self):
-        return self._port
+        return self._number
 
     @port.setter
     def port(self, number):
@@ -89,6 +94,10 @@ class Port:
         return "Port({})".format(repr(self._number))
 
 class Protocol:
+    __slots__ = ('allow_both', '_proto')
+    names = ("both", "tcp", "udp")
+    """The protocol names, indexed by their integer value"""
+    
     def __init__(self, proto, allow_both = True):
         self.allow_both = allow_both
         self.protocol = proto
@@ -122,12 +131,89 @@ class Protocol:
     def __str__(self):
         return self.protocol
 
+httpd_escapes = {" ": "&nbsp;", ":": "&semi;", "<": "&lt;", ">": "&gt;"}
+"""The characters escaped by `httpd_filter_name` and their escaped forms"""
+httpd_escape_table = str.maketrans(httpd_escapes)
+httpd_unescapes = {escaped: char for char, escaped in httpd_escapes.items()}
+httpd_unescape_pattern = re.compile("|".join(re.escape(escaped) for escaped in httpd_unescapes))
+
 def httpd_filter_name(name, unscape = False):
     """This function is a port from base.c, it escapes and unscapes
     names used by ForwardSpec.asp
     http://svn.dd-wrt.com/browser/src/router/httpd/modules/base.c#L2589
+    
+    Both directions are done in a single pass, since none of the 
+    replacements can create a new match the output is the same as 
+    applying every replacement one after the other.
     """
     if not unscape:
-        return name.replace(" ", "&nbsp;").replace(":", "&semi;").replace("<", "&lt;").replace(">", "&gt;")
+        return name.translate(httpd_escape_table)
+    else:
+        return httpd_unescape_pattern.sub(lambda match: httpd_unescapes[match.group()], name)
+
+def httpd_filter_names(names, unscape = False):
+    """Same as `httpd_filter_name`, for a whole list of names at once"""
+    if not unscape:
+        return [name.translate(httpd_escape_table) for name in names]
     else:
-        return name.replace("&nbsp;", " ").replace("&semi;", ":").replace("&lt;", "<").replace("&gt;", ">")
\ No newline at end of file
+        unescape = lambda match: httpd_unescapes[match.group()]
+        return [httpd_unescape_pattern.sub(unescape, name) if "&" in name else name for name in names]
+
+def big_endian_array(typecode, data):
+    """Returns an `array` of *typecode* out of the big endian integers in *data*"""
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == 'little':
+        values.byteswap()
+    return values
+
+def big_endian_bytes(values):
+    """Returns the integers of the `array` *values* as big endian bytes"""
+    if sys.byteorder == 'little':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+def parse_macs(addresses):
+    """Parses an iterable of MAC addresses (strings like the ones accepted
+    by `MAC_address`) into an `array('Q')` of integers. The usual 
+    "AA:BB:CC:DD:EE:FF" form is converted in bulk
+    """
+    digits = [address.replace(':', '') for address in addresses]
+    if all(len(address) == 12 for address in digits):
+        try:
+            return big_endian_array('Q', bytes.fromhex("".join(["0000" + address for address in digits])))
+        except ValueError:
+            pass
+    return array('Q', [int(address, 16) for address in digits])
+
+def format_macs(addresses):
+    """Formats an iterable of integer MAC addresses (like the ones returned
+    by `parse_macs`) into a list of "AA:BB:CC:DD:EE:FF" strings
+    """
+    if not isinstance(addresses, array) or addresses.typecode != 'Q':
+        addresses = array('Q', addresses)
+    digits = big_endian_bytes(addresses).hex().upper()
+    return [":".join((digits[start + 4 : start + 6], digits[start + 6 : start + 8], 
+                      digits[start + 8 : start + 10], digits[start + 10 : start + 12], 
+                      digits[start + 12 : start + 14], digits[start + 14 : start + 16]))
+            for start in range(0, len(digits), 16)]
+
+def parse_ipv4s(addresses):
+    """Parses an iterable of dotted IPv4 addresses into an `array('I')` of
+    integers, raises `ValueError` for anything else
+    """
+    try:
+        packed = b"".join([socket.inet_pton(socket.AF_INET, address) for address in addresses])
+    except (OSError, TypeError) as error:
+        raise ValueError("Expected dotted IPv4 addresses: {}".format(error))
+    return big_endian_array('I', packed)
+
+def format_ipv4s(addresses):
+    """Formats an iterable of integer IPv4 addresses (like the ones 
+    returned by `parse_ipv4s`) into a list of dotted strings
+    """
+    if not isinstance(addresses, array) or addresses.typecode != 'I':
+        addresses = array('I', addresses)
+    packed = big_endian_bytes(addresses)
+    return [socket.inet_ntoa(packed[start : start + 4]) for start in range(0, len(packed), 4)]
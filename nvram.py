@@ -1,108 +1,441 @@
 
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
+from collections.abc import Mapping
+from array import array
 import struct
+import uuid
+import time
+import hashlib
+import threading
+from metrics import instrumented
+from ssh import CommandError
+
+def input_size(result, data, *args):
+    return len(data)
+
+def output_size(result, *args):
+    return len(result)
+
+def written_size(written, *args):
+    return written
+
+def values_size(result, *args):
+    return sum(len(value) for value in result.values())
+
 class NVRAM_Codec:
+    items_struct = struct.Struct('H')
+    key_size_struct = struct.Struct('B')
+    value_size_struct = struct.Struct('H')
+    metrics = None
+    """A sink (see `metrics.AggregateSink`) decoding and encoding is
+    reported to, set it on the class to instrument every codec"""
+
     def __init__(self, header = b'DD-WRT'):
         self.header = header
     
+    @instrumented("codec.decode", input_size)
     def decode(self, data, ordered = True, allow_duplicated_key = True):
         """Decodes a DD-WRT nvram backup, if *ordered* is True
         this function will return an OrderedDict instead of a 
         dict. This can be useful when encoding backups again
         since the order is preserved
         """
-        self.to_decode = data
-        header = self.get_header()
-        if header != self.header:
-            raise IOError("The NVRAM decoder expected to find {} as a header but instead got {}".format(
-                repr(self.header), repr(header)))
-        size = len(self.to_decode)
-        position = len(self.header) + 2
+        with memoryview(data) as view:
+            self.check_header(view)
+            if ordered:
+                dictionary = OrderedDict()
+            else:
+                dictionary = {}
+            
+            for key_start, key_end, value_start, value_end in self.iter_offsets(view):
+                self.store(dictionary, view[key_start : key_end].tobytes(), 
+                           view[value_start : value_end].tobytes(), allow_duplicated_key)
+            self.check_items(view, len(dictionary))
+        return dictionary
+    
+    @instrumented("codec.decode_stream")
+    def decode_stream(self, chunks, ordered = True, allow_duplicated_key = True):
+        """Same as `.decode`, but the backup is read from the iterable
+        *chunks*, which can be split at any point. Every chunk is decoded 
+        as soon as it's received
+        """
+        decoder = NVRAM_StreamDecoder(self)
         if ordered:
             dictionary = OrderedDict()
         else:
             dictionary = {}
-        
+        for chunk in chunks:
+            for key, value in decoder.feed(chunk):
+                self.store(dictionary, key, value, allow_duplicated_key)
+        decoder.close()
+        self.check_length(decoder.expected_items, len(dictionary))
+        return dictionary
+    
+    def store(self, dictionary, key, value, allow_duplicated_key):
+        if (not allow_duplicated_key) and (key in dictionary):
+            raise KeyError("{} already exists in the dictionary, as {}".format(
+                repr(key), repr({key : dictionary[key]})))
+        dictionary[key] = value
+    
+    def iter_offsets(self, data):
+        """Walks the items of the backup *data* (anything supporting the
+        buffer protocol) in a single pass, yielding 
+        `(key_start, key_end, value_start, value_end)` for every item 
+        without copying any of them
+        """
+        size = len(data)
+        position = len(self.header) + 2
+        unpack_key_size = self.key_size_struct.unpack_from
+        unpack_value_size = self.value_size_struct.unpack_from
         while position < size:
-            key_size = self.get_key_size(position)
-            position += 1
+            try:
+                key_size = unpack_key_size(data, position)[0]
+            except struct.error:
+                self.stream_ended(data, position, 1)
+            key_start = position + 1
+            position = key_start + key_size
             
-            key = self.get_key(position, key_size)
-            position += key_size
+            try:
+                value_size = unpack_value_size(data, position)[0]
+            except struct.error:
+                self.stream_ended(data, position, 2)
+            value_start = position + 2
+            position = value_start + value_size
             
-            value_size = self.get_value_size(position)
-            position += 2
-            
-            value = self.get_value(position, value_size)
-            position += value_size
-            
-            if (not allow_duplicated_key) and (key in dictionary):
-                raise KeyError("{} already exists in the dictionary, as {}".format(
-                    repr(key), repr({key : dictionary[key]})))
-            dictionary[key] = value
-        expected_length = self.get_items()
-        length = len(dictionary) 
+            yield key_start, value_start - 2, value_start, position
+    
+    def stream_ended(self, data, pos, size):
+        raise LookupError("The stream ended before we got all the items items." 
+                          "Postion {}, subset {}".format(
+            repr(pos), repr(bytes(data[pos : pos + size]))))
+    
+    def check_header(self, data):
+        """Raises `IOError` if *data* doesn't start with the expected header
+        """
+        header = self.get_header(data)
+        if header != self.header:
+            raise IOError("The NVRAM decoder expected to find {} as a header but instead got {}".format(
+                repr(self.header), repr(header)))
+    
+    def check_items(self, data, length):
+        """Raises `IOError` if *length* doesn't match the number of items 
+        stored in *data*
+        """
+        self.check_length(self.get_items(data), length)
+    
+    def check_length(self, expected_length, length):
         if expected_length != length:
             raise IOError("The NVRAM decoder expected the dictionary of items to be {} elements long, but instead got {}".format(
                                 repr(expected_length), repr(length)))
-        return dictionary
     
-    def get_header(self):
-        """Returns the header of the binary
+    def get_header(self, data):
+        """Returns the header of the binary *data*
         """
-        return self.to_decode[:len(self.header)]
+        return bytes(data[:len(self.header)])
     
-    def get_items(self):
-        """Returns the number of items stored
+    def get_items(self, data):
+        """Returns the number of items stored in *data*
         """
-        return struct.unpack('H', self.to_decode[len(self.header):len(self.header) + 2])[0]
+        return self.items_struct.unpack_from(data, len(self.header))[0]
     
-    def get_key_size(self, pos):
-        """Reads the size of a key at position *pos*
+    @instrumented("codec.encode", bytes_out = output_size)
+    def encode(self, data):
+        """Encodes the dictionary *data* into a DD-WRT nvram backup, 
+        ready to be uploaded as a restore. The size of the image is 
+        computed up front and the items are packed into a single 
+        buffer, returned as `bytes`
         """
-        subset = self.to_decode[pos : pos + 1]
-        try:
-            return struct.unpack('B', subset)[0]
-        except struct.error as error:
-            if len(subset) < 1:
-                raise LookupError("The stream ended before we got all the items items." 
-                                  "Postion {}, subset {}".format(
-                    repr(pos), repr(subset)))
-            else: 
-                raise error
+        items = self.encodable_items(data)
+        encoded = bytearray(self.encoded_size(items))
+        position = len(self.header)
+        encoded[:position] = self.header
+        self.items_struct.pack_into(encoded, position, len(items))
+        position += 2
+        
+        pack_value_size = self.value_size_struct.pack_into
+        for key, value in items:
+            key_end = position + 1 + len(key)
+            encoded[position] = len(key)
+            encoded[position + 1 : key_end] = key
+            pack_value_size(encoded, key_end, len(value))
+            position = key_end + 2 + len(value)
+            encoded[key_end + 2 : position] = value
+        
+        return bytes(encoded)
     
-    def get_key(self, pos, size):
-        """Reads a key at position *pos* of the size *size*
+    @instrumented("codec.encode_to", bytes_out = written_size)
+    def encode_to(self, data, fileobj, chunk_size = 32768):
+        """Encodes the dictionary *data* the same way `.encode` does, but 
+        writes the image to *fileobj* (a file, an ssh channel, anything 
+        with a `write` method) in chunks of roughly *chunk_size* bytes 
+        instead of building it in memory. Returns the number of bytes written
         """
-        return self.to_decode[pos: pos + size]
+        items = self.encodable_items(data)
+        chunk = bytearray(self.header)
+        chunk += self.items_struct.pack(len(items))
+        written = 0
+        pack_key_size = self.key_size_struct.pack
+        pack_value_size = self.value_size_struct.pack
+        for key, value in items:
+            chunk += pack_key_size(len(key))
+            chunk += key
+            chunk += pack_value_size(len(value))
+            chunk += value
+            if len(chunk) >= chunk_size:
+                fileobj.write(chunk)
+                written += len(chunk)
+                chunk = bytearray()
+        if chunk:
+            fileobj.write(chunk)
+            written += len(chunk)
+        return written
     
-    def get_value_size(self, pos):
-        """Reads the size of a value at position *pos*
+    def encoded_size(self, items):
+        """Returns the size of the image holding *items*, a list of
+        `(key, value)` byte strings
         """
-        subset = self.to_decode[pos : pos + 2]
-        try:
-            return struct.unpack('H', subset)[0]
-        except struct.error as error:
-            if len(subset) < 2:
-                raise LookupError("The stream ended before we got all the items items." 
-                                  "Postion {}, subset {}".format(
-                    repr(pos), repr(subset)))
-            else: 
-                raise error
+        return len(self.header) + 2 + sum(3 + len(key) + len(value) for key, value in items)
     
-    def get_value(self, pos, size):
-        """Reads a value at position *pos* of the size *size*
+    def encodable_items(self, data):
+        """Returns the items of *data* as a list of `(key, value)` byte 
+        strings, raises `ValueError` if any of them wouldn't fit in the 
+        DD-WRT format (an image with more than 65535 items, keys longer 
+        than 255 bytes or values longer than 65535 bytes)
         """
-        return self.to_decode[pos : pos + size]
+        items = []
+        for key, value in data.items():
+            key, value = as_bytes(key), as_bytes(value)
+            if len(key) > 255:
+                raise ValueError("Keys can't be longer than 255 bytes, {} is {} bytes long".format(
+                    repr(key), repr(len(key))))
+            if len(value) > 65535:
+                raise ValueError("Values can't be longer than 65535 bytes, the value for {} is {} bytes long".format(
+                    repr(key), repr(len(value))))
+            items.append((key, value))
+        if len(items) > 65535:
+            raise ValueError("Backups can't hold more than 65535 items, got {}".format(
+                repr(len(items))))
+        return items
+
+class NVRAM_StreamDecoder:
+    """Decodes a DD-WRT nvram backup incrementally, the backup can be fed
+    in chunks split at any point and every item is returned as soon as 
+    it's complete, so only the last incomplete item is kept in memory
+    """
+    def __init__(self, codec = None):
+        """:codec: The `NVRAM_Codec` whose format is decoded"""
+        self.codec = NVRAM_Codec() if codec is None else codec
+        self.buffer = bytearray()
+        self.expected_items = None
     
-    def encode(self, data):
-        length = len(data)
-        encoded = self.header + struct.pack('H', length)
+    def feed(self, data):
+        """Adds *data* to the stream, returns a list with the `(key, value)`
+        pairs completed by it
+        """
+        buffer = self.buffer
+        buffer += data
+        position = 0
+        if self.expected_items is None:
+            position = len(self.codec.header) + 2
+            if len(buffer) < position:
+                return []
+            self.codec.check_header(buffer)
+            self.expected_items = self.codec.get_items(buffer)
         
-        for key, value in data.items():
-            encoded += struct.pack('B', len(key))[0:1] + key + struct.pack('H', len(value))[0:2] + value
+        pairs = []
+        size = len(buffer)
+        unpack_value_size = self.codec.value_size_struct.unpack_from
+        while position < size:
+            key_end = position + 1 + buffer[position]
+            if key_end + 2 > size:
+                break
+            value_start = key_end + 2
+            value_end = value_start + unpack_value_size(buffer, key_end)[0]
+            if value_end > size:
+                break
+            pairs.append((bytes(buffer[position + 1 : key_end]), bytes(buffer[value_start : value_end])))
+            position = value_end
+        del buffer[:position]
+        return pairs
+    
+    def close(self):
+        """Raises `LookupError` if the stream ended in the middle of an item"""
+        if self.expected_items is None or self.buffer:
+            raise LookupError("The stream ended before we got all the items items."
+                              "Subset {}".format(repr(bytes(self.buffer))))
 
-        return encoded
+def as_bytes(value):
+    """Returns *value* as a byte string, text is encoded and anything
+    else (like the integers stored by `ddwrt_leases`) is converted to
+    text first
+    """
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, (bytearray, memoryview)):
+        return bytes(value)
+    return str(value).encode()
+
+class NVRAM_Snapshot(Mapping):
+    """A read-only view of a raw nvram backup. The backup is scanned only
+    once to record where every key and value starts, keys are found through
+    an open addressing hash table of those offsets and values are sliced
+    out of the backup when they're requested, so the memory used is close
+    to the size of the backup itself. It can be used as the snapshot of
+    an `NVRAM_Cache`.
+    """
+    def __init__(self, data, codec = None):
+        """:data: A raw nvram backup, as returned by `NVRAM.backup`
+        :codec: The `NVRAM_Codec` used to read the backup
+        """
+        self.codec = NVRAM_Codec() if codec is None else codec
+        self.data = data
+        self.buffer = memoryview(data)
+        self.codec.check_header(self.buffer)
+        self.key_offsets = array('I')
+        self.value_offsets = array('I')
+        items = self.codec.get_items(self.buffer)
+        capacity = 8
+        while capacity < items * 2:
+            capacity *= 2
+        self.slots = array('i', [-1]) * capacity
+        for key_start, key_end, value_start, value_end in self.codec.iter_offsets(self.buffer):
+            slot = self.find_slot(self.buffer[key_start : key_end])
+            item = self.slots[slot]
+            if item >= 0:
+                self.value_offsets[item] = value_start
+            elif len(self.key_offsets) * 2 >= len(self.slots):
+                raise IOError("The NVRAM decoder expected {} items but the backup holds more".format(
+                    repr(items)))
+            else:
+                self.slots[slot] = len(self.key_offsets)
+                self.key_offsets.append(key_start)
+                self.value_offsets.append(value_start)
+        self.codec.check_items(self.buffer, len(self.key_offsets))
+    
+    def find_slot(self, key):
+        """Returns the slot of the hash table holding *key* (bytes or a
+        `memoryview`), or the empty slot it would be stored in
+        """
+        mask = len(self.slots) - 1
+        slot = hash(bytes(key)) & mask
+        while True:
+            item = self.slots[slot]
+            if item < 0 or self.key(item) == key:
+                return slot
+            slot = (slot + 1) & mask
+    
+    def key(self, item):
+        """Returns the key of the *item*-th item as a `memoryview`"""
+        key_start = self.key_offsets[item]
+        return self.buffer[key_start : key_start + self.buffer[key_start - 1]]
+    
+    def find(self, key):
+        """Returns the position of *key* in the offset arrays, raises
+        `KeyError` if it isn't in the backup
+        """
+        key = as_bytes(key)
+        item = self.slots[self.find_slot(key)]
+        if item < 0:
+            raise KeyError(key)
+        return item
+    
+    def view(self, key):
+        """Returns the value for *key* as a `memoryview` over the backup,
+        without copying it
+        """
+        value_start = self.value_offsets[self.find(key)]
+        value_size = self.codec.value_size_struct.unpack_from(self.buffer, value_start - 2)[0]
+        return self.buffer[value_start : value_start + value_size]
+    
+    def __getitem__(self, key):
+        return self.view(key).tobytes()
+    
+    def __contains__(self, key):
+        return self.slots[self.find_slot(as_bytes(key))] >= 0
+    
+    def __iter__(self):
+        for item in range(len(self.key_offsets)):
+            yield self.key(item).tobytes()
+    
+    def __len__(self):
+        return len(self.key_offsets)
+    
+    def copy(self):
+        """Returns the whole backup decoded as an `OrderedDict`
+        """
+        return OrderedDict((key, self[key]) for key in self)
+
+def diff_nvram(current, desired, unset_missing = False):
+    """Returns `(sets, unsets)`, the minimal changeset that turns the nvram
+    dictionary *current* (a decoded backup or a `NVRAM_Snapshot`) into
+    *desired*. Keys are compared as bytes, so `str` keys in *desired* 
+    match the `bytes` keys of a decoded backup. Keys set to `None` in
+    *desired* are unset, and so are the keys missing from it if 
+    *unset_missing* is True. `sets` is { key: value, ... } and `unsets`
+    [key, ...], both with byte string keys and values
+    """
+    lazy = isinstance(current, NVRAM_Snapshot)
+    sets = OrderedDict()
+    unsets = []
+    wanted = set()
+    for key, value in desired.items():
+        key = as_bytes(key)
+        wanted.add(key)
+        if value is None:
+            if key in current:
+                unsets.append(key)
+            continue
+        value = as_bytes(value)
+        if key not in current:
+            sets[key] = value
+        elif (current.view(key) if lazy else current[key]) != value:
+            sets[key] = value
+    if unset_missing:
+        unsets += [key for key in current if as_bytes(key) not in wanted]
+    return sets, unsets
+
+class NVRAM_Overlay(Mapping):
+    """A read-only view of a snapshot with a changeset applied on top, the
+    snapshot is never copied and lookups fall through the changeset into
+    it. Returned by `NVRAM_Cache.get_snapshot`
+    """
+    def __init__(self, snapshot, changeset, length):
+        self.snapshot = snapshot
+        self.changeset = changeset
+        self.length = length
+    
+    def __getitem__(self, key):
+        key = as_bytes(key)
+        value = self.changeset.get(key)
+        if value is None:
+            return self.snapshot[key]
+        if value is NVRAM_Cache.void:
+            raise KeyError(key)
+        return value
+    
+    def __contains__(self, key):
+        key = as_bytes(key)
+        value = self.changeset.get(key)
+        if value is None:
+            return key in self.snapshot
+        return value is not NVRAM_Cache.void
+    
+    def __iter__(self):
+        void = NVRAM_Cache.void
+        changeset = self.changeset
+        for key in self.snapshot:
+            if changeset.get(key) is not void:
+                yield key
+        for key, value in changeset.items():
+            if value is not void and key not in self.snapshot:
+                yield key
+    
+    def __len__(self):
+        return self.length
+    
+    def copy(self):
+        """Returns the view materialized as an `OrderedDict`"""
+        return OrderedDict(self.items())
 
 class NVRAM_Cache:
     class void:
@@ -113,146 +446,687 @@ class NVRAM_Cache:
     dumping the resultant changes into a new nvram snapshot (ready to be 
     encoded and uploaded as a restore) or applying a changeset instead 
     issuing a lot of independent ssh commands.
+    
+    The snapshot is never copied, the changeset is kept as a single 
+    { key: value or `void` } layer on top of it with keys and values 
+    stored as bytes. `.savepoint` starts a nested layer of edits that can
+    be undone with `.rollback` or kept with `.release`. The value every
+    edited key had in the snapshot is recorded the first time it's edited
+    (see `.get_bases`), so the changes can be applied only if the router
+    still holds those values (see `NVRAM.apply_if_unchanged`).
     """
     def __init__(self, snapshot, key_not_found = ''):
-        """:snapshot: A dictionary representig the router's nvram
+        """:snapshot: A dictionary representig the router's nvram with bytes 
+        keys, or a `NVRAM_Snapshot` of it
         """
-        self.key_not_found = key_not_found.encode()
+        self.key_not_found = as_bytes(key_not_found)
         self.snapshot = snapshot
-        self.changeset = {}
+        self.changeset = OrderedDict()
+        self.bases = {}
+        self.savepoints = []
+        self.length = len(snapshot)
+        self.shared = False
     
     def get(self, key):
         """Returns `value` for :key: on the nvram dictionary
         :key: A key
         """
-        if key in self.changeset:
-            if self.changeset[key] is self.void:
-                return self.key_not_found
-            else: return self.changeset[key].encode()
-        elif key in self.snapshot:
-            return self.snapshot[key]
-        else: return self.key_not_found
+        key = as_bytes(key)
+        value = self.changeset.get(key)
+        if value is None:
+            return self.snapshot[key] if key in self.snapshot else self.key_not_found
+        if value is self.void:
+            return self.key_not_found
+        return value
+    
+    def get_many(self, keys):
+        """Returns { key: value, ... } for every key in *keys*, the same 
+        way `.get` does
+        """
+        return {key: self.get(key) for key in keys}
     
     def set(self, key, value):
         """Adds `key` and `value` to the changeset
         :key: A key
         :value: A value
         """
-        self.changeset[key] = value
+        self.write(as_bytes(key), as_bytes(value))
     
     def unset(self, key):
         """Queues a removal on the changeset
         :key: A key
         """
-        self.changeset[key] = self.void
+        self.write(as_bytes(key), self.void)
+    
+    def write(self, key, value):
+        if self.shared:
+            self.changeset = OrderedDict(self.changeset)
+            self.shared = False
+        if self.savepoints:
+            self.savepoints[-1].setdefault(key, self.changeset.get(key))
+        if key not in self.bases:
+            self.bases[key] = self.snapshot[key] if key in self.snapshot else None
+        present = self.contains(key)
+        self.changeset[key] = value
+        self.length += (value is not self.void) - present
+    
+    def contains(self, key):
+        value = self.changeset.get(key)
+        if value is None:
+            return key in self.snapshot
+        return value is not self.void
+    
+    def savepoint(self):
+        """Starts a nested layer of edits, returns its depth to be given to
+        `.rollback` or `.release`
+        """
+        self.savepoints.append({})
+        return len(self.savepoints)
+    
+    def rollback(self, savepoint = None):
+        """Undoes every edit made since *savepoint* (the latest one if 
+        `None`) and drops it along with the savepoints nested in it
+        """
+        for undo in reversed(self.drop_savepoints(savepoint)):
+            if self.shared:
+                self.changeset = OrderedDict(self.changeset)
+                self.shared = False
+            for key, value in undo.items():
+                present = self.contains(key)
+                if value is None:
+                    self.changeset.pop(key, None)
+                else:
+                    self.changeset[key] = value
+                self.length += self.contains(key) - present
+    
+    def release(self, savepoint = None):
+        """Keeps the edits made since *savepoint* (the latest one if `None`)
+        as part of the enclosing savepoint, if any, and drops it
+        """
+        undos = self.drop_savepoints(savepoint)
+        if self.savepoints:
+            parent = self.savepoints[-1]
+            for undo in undos:
+                for key, value in undo.items():
+                    parent.setdefault(key, value)
+    
+    def drop_savepoints(self, savepoint):
+        if not self.savepoints:
+            raise LookupError("There's no savepoint")
+        depth = len(self.savepoints) if savepoint is None else savepoint
+        if not 0 < depth <= len(self.savepoints):
+            raise LookupError("There's no savepoint {}".format(repr(savepoint)))
+        undos = self.savepoints[depth - 1:]
+        del self.savepoints[depth - 1:]
+        return undos
     
     def get_changes(self):
         """Returns `(sets, unsets)` where `sets` is a dictionary containing
         { key: value, key1: value1, ... } the previously queued sets, and
         `unsets` is a list containing [keyrem, keyrem1, ...] the queued unsets
         """
-        sets = {}
+        sets = OrderedDict()
         unsets = []
-        self.do_for_items(lambda key, value: sets.__setitem__(key, value),
-                          lambda key: unsets.__iadd__([key]))
+        void = self.void
+        for key, value in self.changeset.items():
+            if value is void:
+                unsets.append(key)
+            else:
+                sets[key] = value
         return sets, unsets
             
+    def get_bases(self):
+        """Returns { key: value, ... } with the value every key in the 
+        changeset had in the snapshot when it was first edited, `None` if
+        it wasn't there. Updating the snapshot doesn't change them
+        """
+        return OrderedDict((key, self.bases[key]) for key in self.changeset)
+    
     def get_snapshot(self):
-        snapshot = self.snapshot.copy()
-        self.do_for_items(lambda key, value: snapshot.__setitem__(key, value),
-                          lambda key: snapshot.pop(key, None))
-        return snapshot
+        """Returns an `NVRAM_Overlay` of the snapshot with the changeset
+        applied. Neither of them is copied, the changeset is only copied
+        if it's edited while the overlay is still around
+        """
+        self.shared = True
+        return NVRAM_Overlay(self.snapshot, self.changeset, self.length)
+    
+    def apply_changes(self, sets, unsets):
+        """Queues every set in *sets* ({ key: value, ... }) and every unset
+        in *unsets* ([key, ...]), like the ones returned by `diff_nvram`
+        """
+        for key, value in sets.items():
+            self.set(key, value)
+        for key in unsets:
+            self.unset(key)
     
-    def do_for_items(self, set_func, unset_func):
-        for key, value in self.changeset.items():
-            if value is self.void:
-                unset_func(key)
-            else:
-                set_func(key, value)
-        
     def update_snapshot(self, snapshot):
         """Updates the current snapshot to `snapshot`
         """
         self.snapshot = snapshot
+        self.length = len(snapshot)
+        for key, value in self.changeset.items():
+            self.length += (value is not self.void) - (key in snapshot)
+
+class NVRAM_ReadCache:
+    """A bounded read-through cache for `NVRAM.get`, every value expires 
+    after its time to live and the least recently used ones are evicted 
+    once there are more than *max_size*. It's safe to share between
+    threads
+    """
+    def __init__(self, ttl = 5.0, max_size = 256, ttls = None, clock = time.monotonic):
+        """:ttl: Seconds a value is kept for
+        :max_size: The maximum number of values kept
+        :ttls: A dictionary of { key: ttl, ... } overriding *ttl* for some keys
+        :clock: The function used to tell the time
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.ttls = {as_bytes(key): value for key, value in (ttls or {}).items()}
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def get(self, key):
+        """Returns the value cached for *key*, or `None` if there's none or
+        it expired
+        """
+        key = as_bytes(key)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= self.clock():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+    
+    def put(self, key, value):
+        key = as_bytes(key)
+        entry = (self.clock() + self.ttls.get(key, self.ttl), as_bytes(value))
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last = False)
+    
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(as_bytes(key), None)
+    
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+    
+    def keys(self):
+        with self.lock:
+            return list(self.entries)
+
+NVRAM_Conflict = namedtuple('NVRAM_Conflict', ['key', 'expected', 'actual'])
+"""A key whose value on the router (*actual*) isn't the one the changes
+were based on (*expected*), `None` meaning the key doesn't exist"""
+
+class NVRAM_ConflictError(IOError):
+    """Raised when changes aren't applied because the router's nvram 
+    changed since they were made, *conflicts* is a list of `NVRAM_Conflict`
+    """
+    def __init__(self, conflicts):
+        super().__init__("The nvram changed on the router, conflicting keys: {}".format(
+            ", ".join(repr(conflict.key) for conflict in conflicts)))
+        self.conflicts = conflicts
+
+class NVRAM_PartialApply(IOError):
+    """Raised when only some of the changes were applied, the first
+    *applied* commands of *commands* ran and the next one failed. The
+    applied ones aren't rolled back. *result* is the `CommandResult` of
+    the script
+    """
+    def __init__(self, commands, applied, result):
+        super().__init__("{} of {} changes were applied before {} failed: {}".format(
+            applied, len(commands), repr(commands[applied]), result.stderr.decode(errors = 'replace').strip()))
+        self.commands = commands
+        self.applied = applied
+        self.result = result
 
 class NVRAM:
-    def __init__(self, ssh_router):
+    max_command_length = 16384
+    """Changesets are split into commands no longer than this"""
+    restore_ratio = 0.25
+    """When exiting cache mode with `as_changeset = None`, changesets at
+    least this big relative to the size of the whole restore image are
+    pushed as a restore"""
+    temporary_path = "/tmp/nvram_{}.bin"
+    """Where backups and restores are stored on the router while they're
+    transferred, formatted with a random name"""
+    metrics = None
+    """A sink (see `metrics.AggregateSink`) every operation is reported
+    to, set it on the class to instrument every instance"""
+    checksum_probe = "md5sum < /dev/null | grep -q '^d41d8cd98f00b204e9800998ecf8427e '"
+    """Succeeds if the router can check the values `.apply_if_unchanged`
+    dumps"""
+    
+    def __init__(self, ssh_router, read_cache = None):
+        """:ssh_router: A `ddwrt_ssh` instance
+        :read_cache: A `NVRAM_ReadCache` used by `.get` and `.get_many`
+        outside of cache mode, `None` to always ask the router
+        """
         self.cache_mode = False
         self.router = ssh_router
+        self.read_cache = read_cache
     
+    @instrumented("nvram.set")
     def set(self, key, value):
         """Sets 'value' for 'key' on the router's nvram dictionary""" 
-        if not self.is_valid_key(key):
-            raise KeyError("{} is not a valid key, try removing the '='".format(repr(key)))
+        self.check_keys([key])
         if self.cache_mode:
             self.cache.set(key, value)
         else:
-            command = "nvram set {}".format(self.router.quote("{}={}".format(key, value)))
-            self.router.client.exec_command(command)
+            self.router.run(self.set_command(key, value), check = True)
+            if self.read_cache is not None:
+                self.read_cache.put(key, value)
     
+    @instrumented("nvram.unset")
     def unset(self, key):
         """Unsets 'key' on the router's nvram dictionary""" 
         if self.cache_mode:
             self.cache.unset(key)
         else:
-            command = "nvram unset {}".format(self.router.quote(key))
-            self.router.client.exec_command(command)
+            self.router.run(self.unset_command(key), check = True)
+            if self.read_cache is not None:
+                self.read_cache.put(key, b'')
     
+    @instrumented("nvram.get", output_size)
     def get(self, key):
         """Returns a value for 'key' on the router's nvram dictionary""" 
         if self.cache_mode:
             return self.cache.get(key)
+        elif self.read_cache is not None:
+            return self.get_many([key])[key]
         else:
             command = "nvram get {}".format(self.router.quote(key))
-            stdout = self.router.client.exec_command(command)[1]
-            return stdout.read()[:-1]
+            return self.router.run(command).stdout[:-1]
+    
+    @instrumented("nvram.get_many", values_size)
+    def get_many(self, keys):
+        """Returns { key: value, ... } for every key in *keys*, fetched with 
+        as few commands as `max_command_length` allows. Every value is followed by a random delimiter on
+        its own line so values containing newlines survive the trip
+        """
+        keys = list(keys)
+        if self.cache_mode:
+            return self.cache.get_many(keys)
+        if self.read_cache is None:
+            return self.fetch_many(keys)
+        values = {}
+        for key in keys:
+            value = self.read_cache.get(key)
+            if value is not None:
+                values[key] = value
+        missing = [key for key in keys if key not in values]
+        for key, value in self.fetch_many(missing).items():
+            self.read_cache.put(key, value)
+            values[key] = value
+        return values
     
+    def fetch_many(self, keys):
+        """Fetches *keys* from the router the way `.get_many` describes, 
+        skipping the read cache
+        """
+        if not keys:
+            return {}
+        delimiter = uuid.uuid4().hex
+        commands = ["nvram get {}; echo {}".format(self.router.quote(self.as_text(key)), delimiter) 
+                    for key in keys]
+        groups = list(self.group_commands(commands))
+        results = self.router.run_many(["; ".join(group) for group in groups])
+        values = {}
+        keys = iter(keys)
+        for group, result in zip(groups, results):
+            batch = result.stdout.split(delimiter.encode() + b"\n")
+            if len(batch) != len(group) + 1:
+                raise IOError("Expected {} values, but instead got {}".format(
+                    repr(len(group)), repr(len(batch) - 1)))
+            for value in batch[:-1]:
+                values[next(keys)] = value[:-1]
+        return values
+    
+    @instrumented("nvram.get_all")
     def get_all(self):
-        """Returns a dictionary representing the router's nvram dictionary""" 
-        return NVRAM_Codec().decode(self.backup())
+        """Returns a dictionary representing the router's nvram dictionary,
+        decoded while the backup is being transferred
+        """ 
+        return NVRAM_Codec().decode_stream(self.iter_backup())
+    
+    def iter_all(self, chunk_size = 32768):
+        """Yields the `(key, value)` pairs of the router's nvram dictionary
+        as they're received, duplicated keys are yielded as they come
+        """
+        decoder = NVRAM_StreamDecoder()
+        for chunk in self.iter_backup(chunk_size):
+            for pair in decoder.feed(chunk):
+                yield pair
+        decoder.close()
+    
+    def get_snapshot(self):
+        """Returns a read-only `NVRAM_Snapshot` of the router's nvram 
+        dictionary, values are only decoded when they're accessed
+        """
+        return NVRAM_Snapshot(self.backup())
+    
+    def refresh(self, keys = None):
+        """Fetches *keys* (every cached key if `None`) again into the read
+        cache, returns { key: value, ... }
+        """
+        if self.read_cache is None:
+            raise ValueError("This NVRAM instance has no read cache")
+        keys = self.read_cache.keys() if keys is None else list(keys)
+        values = self.fetch_many(keys)
+        for key, value in values.items():
+            self.read_cache.put(key, value)
+        return values
     
+    @instrumented("nvram.commit")
     def commit(self):
         """Writes the changes made (not exclusively by this aplication) 
         to the nvram dictionary since the last commit 
         """
         command = "nvram commit"
-        self.router.client.exec_command(command)
+        self.router.run(command, check = True)
     
+    @instrumented("nvram.backup", output_size)
     def backup(self):
         """Returns a byte array object, ready to be decoded or saved 
         to a local file
         """
-        command = "nvram backup /dev/tty"
-        stdout = self.router.pipe_to_stdin(command)[1]
-        return self.router.chop_header(stdout.read())
+        return b''.join(self.iter_backup())
+    
+    def iter_backup(self, chunk_size = 32768):
+        """Yields the backup in chunks of up to *chunk_size* bytes as they're
+        transferred
+        """
+        path = self.temporary_path.format(uuid.uuid4().hex)
+        command = "nvram backup {}".format(self.router.quote(path))
+        return self.router.iter_file_from(command, path, chunk_size, "nvram backup /dev/tty")
     
+    def sync(self, desired, unset_missing = False, snapshot = None):
+        """Makes the router's nvram dictionary match *desired* by pushing
+        only the keys that differ (see `diff_nvram`), *snapshot* is the 
+        router's current dictionary, fetched if it's `None`. In cache mode
+        the changes are queued on the cache instead.
+        Returns the `(sets, unsets)` that were applied
+        """
+        if snapshot is None:
+            snapshot = self.cache.get_snapshot() if self.cache_mode else self.get_snapshot()
+        sets, unsets = diff_nvram(snapshot, desired, unset_missing)
+        self.check_keys(sets)
+        if self.cache_mode:
+            self.cache.apply_changes(sets, unsets)
+        elif sets or unsets:
+            self.push_changeset(sets, unsets)
+        return sets, unsets
+    
+    @instrumented("nvram.restore")
+    def restore(self, snapshot):
+        """Replaces the router's nvram dictionary with *snapshot*, it gets 
+        encoded with `NVRAM_Codec`, uploaded in a single transfer and loaded
+        with `nvram restore`
+        """
+        codec = NVRAM_Codec()
+        path = self.temporary_path.format(uuid.uuid4().hex)
+        command = "nvram restore {}".format(self.router.quote(path))
+        self.router.send_file_to(path, lambda remote: codec.encode_to(snapshot, remote), command)
+        if self.read_cache is not None:
+            self.read_cache.clear()
+    
+    @instrumented("nvram.push_changeset")
+    def push_changeset(self, sets, unsets):
+        """Applies *sets* ({ key: value, ... }) and *unsets* ([key, ...]) 
+        with as few commands as possible, none of them longer than 
+        `max_command_length`. The batches run one after another and stop
+        at the first command failing, `NVRAM_PartialApply` is raised naming
+        it and the commands before it stay applied
+        """
+        self.check_keys(sets)
+        commands = [self.set_command(key, value) for key, value in sets.items()]
+        commands += [self.unset_command(key) for key in unsets]
+        delimiter = uuid.uuid4().hex
+        marker = "{} applied ".format(delimiter).encode()
+        offset = 0
+        for group in self.group_commands(commands, len(" && applied=") + 12, 
+                                         len("applied=0; { ; } > /dev/null; echo  applied $applied") + len(delimiter)):
+            script = "applied=0; {{ {}; }} > /dev/null; echo {} applied $applied".format(
+                     self.counted_commands(group), delimiter)
+            result = self.router.run(script)
+            applied = None
+            if result.status == 0 and result.stdout.startswith(marker):
+                applied = int(result.stdout[len(marker):])
+            if applied is None or applied < len(group):
+                self._cache_changes(sets, unsets, False)
+                if applied is None:
+                    raise CommandError(script, result)
+                raise NVRAM_PartialApply(commands, offset + applied, result)
+            offset += len(group)
+        self._cache_changes(sets, unsets, True)
+    
+    @instrumented("nvram.apply_if_unchanged")
+    def apply_if_unchanged(self, sets, unsets, bases, commit = False):
+        """Applies *sets* and *unsets* (see `.push_changeset`) only if every
+        key in *bases* ({ key: value, ... }, `None` for keys that shouldn't 
+        exist) still has that value on the router, committing afterwards if
+        *commit* is True. The check and the changes run in a single script
+        on the router: the current values are dumped to a temporary file 
+        and the changes only applied if its checksum is the expected one.
+        Scripts longer than `max_command_length` are uploaded and ran with
+        `sh`. It needs `md5sum` and `grep` on the router, `IOError` is 
+        raised if they're missing.
+        The changes aren't atomic, they're applied one command at a time and
+        the script stops at the first one failing (nvram being full, for
+        instance). The ones before it stay applied and `NVRAM_PartialApply`
+        is raised.
+        Returns a list of `NVRAM_Conflict`, empty if the changes were applied
+        """
+        self.check_keys(sets)
+        commands = [self.set_command(key, value) for key, value in sets.items()]
+        commands += [self.unset_command(key) for key in unsets]
+        if not commands:
+            if commit:
+                self.commit()
+            return []
+        if commit:
+            commands.append("nvram commit")
+        keys = list(bases)
+        delimiter = uuid.uuid4().hex
+        expected = b''.join((b'' if value is None else as_bytes(value) + b"\n") + delimiter.encode() + b"\n"
+                            for value in bases.values())
+        dump = "; ".join("nvram get {}; echo {}".format(self.router.quote(self.as_text(key)), delimiter) 
+                         for key in keys) or "true"
+        path = self.router.quote(self.temporary_path.format(uuid.uuid4().hex))
+        apply = self.counted_commands(commands)
+        script = ("{{ {dump}; }} > {path}; md5sum < {path} | grep -q '^{digest} ' && "
+                  "{{ applied=0; {{ {apply}; }} > /dev/null; echo {delimiter} applied $applied; }}; "
+                  "cat {path}; rm -f {path}").format(
+                  dump = dump, path = path, digest = hashlib.md5(expected).hexdigest(), 
+                  apply = apply, delimiter = delimiter)
+        if len(script) > self.max_command_length:
+            script_path = self.temporary_path.format(uuid.uuid4().hex)
+            result = self.router.send_file_to(script_path, lambda remote: remote.write(script.encode()),
+                                              "sh {}".format(self.router.quote(script_path)))
+        else:
+            result = self.router.run(script, check = True)
+        
+        output = result.stdout
+        marker = "{} applied ".format(delimiter).encode()
+        applied = None
+        if output.startswith(marker):
+            line, output = output.split(b"\n", 1)
+            applied = int(line[len(marker):])
+        values = output.split(delimiter.encode() + b"\n")
+        if len(values) != len(keys) + 1:
+            raise IOError("Expected {} values, but instead got {}".format(
+                repr(len(keys)), repr(len(values) - 1)))
+        if applied is not None and applied < len(commands):
+            self._cache_changes(sets, unsets, False)
+            raise NVRAM_PartialApply(commands, applied, result)
+        conflicts = []
+        for key, value in zip(keys, values):
+            actual = value[:-1] if value else None
+            base = None if bases[key] is None else as_bytes(bases[key])
+            if actual != base:
+                conflicts.append(NVRAM_Conflict(key, base, actual))
+        if applied is None and not conflicts:
+            if self.router.run(self.checksum_probe).status != 0:
+                raise IOError("Can't compare and swap, the router's md5sum or grep are missing or not working")
+            raise CommandError(script, result)
+        if applied is not None:
+            self._cache_changes(sets, unsets, True)
+        return conflicts
+    
+    def _cache_changes(self, sets, unsets, applied):
+        """Updates the read cache after pushing *sets* and *unsets*, their
+        new values are cached if they were *applied*, otherwise what's on
+        the router isn't known and every key they touch is dropped
+        """
+        if self.read_cache is None:
+            return
+        if applied:
+            for key, value in sets.items():
+                self.read_cache.put(key, value)
+            for key in unsets:
+                self.read_cache.put(key, b'')
+        else:
+            for key in list(sets) + list(unsets):
+                self.read_cache.invalidate(key)
+    
+    def counted_commands(self, commands):
+        """Chains *commands* so they stop at the first one failing, every
+        command that succeeds sets `$applied` to how many ran so far, so a
+        partial apply is told apart from a complete one
+        """
+        return " && ".join("{} && applied={}".format(command, count)
+                           for count, command in enumerate(commands, 1))
+    
+    def group_commands(self, commands, extra = 2, reserved = 0):
+        """Splits *commands* into as few lists as possible, every command
+        taking its length plus *extra* and every list *reserved* on top of
+        that, without exceeding `max_command_length` (unless a single 
+        command is longer than that)
+        """
+        group = []
+        length = reserved
+        for command in commands:
+            if group and length + len(command) + extra > self.max_command_length:
+                yield group
+                group = []
+                length = reserved
+            group.append(command)
+            length += len(command) + extra
+        if group:
+            yield group
+    
+    def set_command(self, key, value):
+        return "nvram set {}".format(self.router.quote("{}={}".format(self.as_text(key), self.as_text(value))))
+    
+    def unset_command(self, key):
+        return "nvram unset {}".format(self.router.quote(self.as_text(key)))
+    
+    def as_text(self, value):
+        if isinstance(value, (bytes, bytearray)):
+            return value.decode()
+        return str(value)
+    
+    @instrumented("nvram.enter_cache_mode")
     def enter_cache_mode(self, fetch_all = True):
         """Enters cache mode (local only), while this mode is active, no 
         commands will be submitted to the client, all changes made to 
         the nvram dictionary will only be local, when you exit this mode 
-        all of the changes will be submitted as an nvram restore, only 
-        activate this mode if you need to make a lot of changes to be
-        worth the overhead of having to push a whole nvram restore.
+        all of the changes will be submitted as an nvram restore or as a
+        changeset (see `exit_cache_mode`). If *fetch_all* is True the whole
+        dictionary is fetched once as a lazy `NVRAM_Snapshot`.
         """
         if not self.cache_mode:
-            memory = self.get_all() if fetch_all else OrderedDict()
+            memory = self.get_snapshot() if fetch_all else OrderedDict()
             self.cache = NVRAM_Cache(memory)
+            self.cache_fetched_all = fetch_all
             self.cache_mode = True
     
-    def exit_cache_mode(self, as_changeset = False):
+    @instrumented("nvram.exit_cache_mode")
+    def exit_cache_mode(self, as_changeset = True, compare_and_swap = False, commit = False):
         """Exits cache mode, all of the changes will be submited to the 
-        client as a nvram restore or as a change set
+        client as a change set (the default) or, if *as_changeset* is False,
+        as a nvram restore. If *as_changeset* is `None` the restore is only
+        used when the changeset is big compared to the whole image (see 
+        `restore_ratio`). A restore needs the whole dictionary, so it's not
+        available if cache mode was entered with `fetch_all = False`. The 
+        changes are committed if *commit* is True.
+        
+        A restore writes back the whole dictionary as it was fetched when
+        cache mode was entered plus the changes, so every key changed on 
+        the router since then is overwritten, not only the ones edited.
+        
+        With *compare_and_swap* the changes are pushed as a changeset with
+        `.apply_if_unchanged`, only if none of the keys they touch changed
+        on the router since cache mode was entered. Otherwise nothing is 
+        applied, `NVRAM_ConflictError` is raised and cache mode stays active
+        (see `.discard_cache_mode`). It needs `fetch_all = True` as well
         """
         if self.cache_mode:
-            command = ""
             sets, unsets = self.cache.get_changes()
-            for key, value in sets.items():
-                command += "nvram set {}; ".format(self.router.quote("{}={}".format(key, value)))
-            for key in unsets:
-                command += "nvram unset {}; ".format(self.router.quote(key))
+            if compare_and_swap:
+                if not self.cache_fetched_all:
+                    raise ValueError("Can't compare and swap when cache mode was entered without fetching all the keys")
+                conflicts = self.apply_if_unchanged(sets, unsets, self.cache.get_bases(), commit)
+                if conflicts:
+                    raise NVRAM_ConflictError(conflicts)
+                self.discard_cache_mode()
+                return
+            if as_changeset is None:
+                as_changeset = True
+                if self.cache_fetched_all and (sets or unsets):
+                    as_changeset = not self.prefer_restore(sets, unsets, self.cache.snapshot)
+            if not as_changeset:
+                if not self.cache_fetched_all:
+                    raise ValueError("Can't push a restore when cache mode was entered without fetching all the keys")
+                self.restore(self.cache.get_snapshot())
+            elif sets or unsets:
+                self.push_changeset(sets, unsets)
+            self.discard_cache_mode()
+            if commit:
+                self.commit()
+    
+    def discard_cache_mode(self):
+        """Exits cache mode dropping every change made while it was active"""
+        if self.cache_mode:
             del self.cache
             self.cache_mode = False
-            self.router.client.exec_command(command)
+    
+    def prefer_restore(self, sets, unsets, snapshot):
+        """Returns True if pushing *sets* and *unsets* as commands would take
+        at least `restore_ratio` times the size of the restore image of 
+        *snapshot* with them applied. The size is worked out from the 
+        lengths of the values, none of them is copied out of a `NVRAM_Snapshot`
+        """
+        changeset_size = sum(len(self.set_command(key, value)) + 2 for key, value in sets.items())
+        changeset_size += sum(len(self.unset_command(key)) + 2 for key in unsets)
+        
+        def item_size(key):
+            view = getattr(snapshot, 'view', None)
+            return 3 + len(as_bytes(key)) + len(view(key) if view is not None else as_bytes(snapshot[key]))
+        
+        image_size = len(NVRAM_Codec().header) + 2 + sum(item_size(key) for key in snapshot)
+        for key, value in sets.items():
+            if key in snapshot:
+                image_size -= item_size(key)
+            image_size += 3 + len(as_bytes(key)) + len(as_bytes(value))
+        for key in unsets:
+            if key in snapshot:
+                image_size -= item_size(key)
+        return changeset_size >= self.restore_ratio * image_size
+    
+    def check_keys(self, keys):
+        """Raises `KeyError` if any of *keys* isn't valid (see `.is_valid_key`)"""
+        for key in keys:
+            if not self.is_valid_key(self.as_text(key)):
+                raise KeyError("{} is not a valid key, try removing the '='".format(repr(key)))
     
     def is_valid_key(self, key):
         """Returns true if the key is not going to be misinterpreted by the 
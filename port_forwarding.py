@@ -1,19 +1,33 @@
 
 import ipaddress
-from network_common import State, Protocol, Port, httpd_filter_name
+from array import array
+from collections import namedtuple
+from network_common import State, Protocol, Port, httpd_filter_name, httpd_filter_names
 
 class Name:
+    __slots__ = ('_unescaped', '_escaped')
+    
     def __init__(self, name, escaped = False):
         if escaped:
             self.escaped = str(name)
         else:
             self.unescaped = str(name)
     @property
+    def unescaped(self):
+        return self._unescaped
+    @unescaped.setter
+    def unescaped(self, name):
+        self._unescaped = name
+        self._escaped = None
+    @property
     def escaped(self):
-        return httpd_filter_name(self.unescaped)
+        if self._escaped is None:
+            self._escaped = httpd_filter_name(self._unescaped)
+        return self._escaped
     @escaped.setter
     def escaped(self, name):
-        self.unescaped = httpd_filter_name(str(name), True)
+        self._unescaped = httpd_filter_name(str(name), True)
+        self._escaped = None
     def __repr__(self):
         return "{}({})".format(self.__class__.__name__, repr(self.unescaped))
     def __str__(self):
@@ -22,6 +36,8 @@ class Name:
 class PortForward:
     """This class represents a PortForward stored in a DD-WRT's NVRAM memory
     """
+    __slots__ = ('name', 'state', 'proto', 'to_port', 'to_ip', 'from_port', 'from_ip')
+    
     def __init__(self, 
                  name, 
                  state, 
@@ -61,15 +77,7 @@ class PortForward:
             "{escaped_name}:{state}:{protocol}:{from_port}>{to_ip}:{to_port}"
 
         """
-        name, state, proto, from_port_to_ip, to_port_from_ip = string.split(":")
-        from_port, to_ip = from_port_to_ip.split(">")
-        
-        if to_port_from_ip.find("<") == -1:
-            to_port = to_port_from_ip
-            from_ip = None
-        else:
-            to_port, from_ip = to_port_from_ip.split("<")
-        
+        name, state, proto, from_port, to_ip, to_port, from_ip = split_forward_spec(string)
         return cls(name, state, proto, to_port, to_ip, from_port, True, from_ip)
         
     def __repr__(self):
@@ -91,20 +99,136 @@ class PortForward:
             return "{}:{}:{}:{}>{}:{}".format(
                 self.name, self.state, self.proto, self.from_port, self.to_ip, self.to_port)
 
+def split_forward_spec(string):
+    """Splits an encoded forward_spec forward (see `PortForward.from_forward_spec`)
+    into `(escaped_name, state, protocol, from_port, to_ip, to_port, from_ip)`,
+    *from_ip* is `None` if it's not present
+    """
+    name, state, proto, from_port_to_ip, to_port_from_ip = string.split(":")
+    from_port, to_ip = from_port_to_ip.split(">")
+    
+    if to_port_from_ip.find("<") == -1:
+        to_port = to_port_from_ip
+        from_ip = None
+    else:
+        to_port, from_ip = to_port_from_ip.split("<")
+    return name, state, proto, from_port, to_ip, to_port, from_ip
+
+ForwardConflict = namedtuple('ForwardConflict', ['kind', 'forward', 'existing'])
+"""A forward clashing with *existing*, *kind* is 'port' if both take the 
+same `from_port` on an overlapping protocol or 'name' if they share a name"""
+
 class ddwrt_forwards:
+    """Wraps a list of `PortForward`, indexed by `(protocol, from_port)` 
+    (a forward using both protocols is indexed under tcp and udp) and by 
+    unescaped name. Use `.add` and `.remove` to keep the indexes consistent,
+    or call `.reindex` after editing the forwards list directly
+    """
     def __init__(self, forward_spec_string):
-        self.forwards = []
-        for forward in forward_spec_string.split(" "):
-            self.forwards += [PortForward.from_forward_spec(forward)]
+        self.forwards = [PortForward.from_forward_spec(forward) 
+                         for forward in forward_spec_string.split(" ") if forward]
+        self.reindex()
+    
+    def reindex(self):
+        """Rebuilds the indexes from the forwards list, returns the list of
+        `ForwardConflict` between the forwards, found in a single pass
+        """
+        self.by_port = {}
+        self.by_name = {}
+        conflicts = []
+        for forward in self.forwards:
+            conflicts += self.find_conflicts(forward)
+            self.index(forward)
+        return conflicts
+    
+    def validate(self):
+        """Returns every `ForwardConflict` between the forwards"""
+        return self.reindex()
+    
+    def port_keys(self, forward):
+        proto = int(forward.proto)
+        port = int(forward.from_port)
+        if proto == 0:
+            return [(1, port), (2, port)]
+        return [(proto, port)]
+    
+    def find_by_port(self, proto, port):
+        """Returns the forward taking *port* for *proto* ('tcp' or 'udp'), 
+        `None` if there isn't any
+        """
+        return self.by_port.get((int(Protocol(proto, False)), int(port)))
+    
+    def find_by_name(self, name):
+        """Returns the forward named *name* (unescaped), `None` if there isn't any"""
+        return self.by_name.get(name)
+    
+    def find_conflicts(self, forward):
+        """Returns a list of `ForwardConflict` between *forward* and the
+        indexed forwards
+        """
+        conflicts = []
+        clashing = []
+        for key in self.port_keys(forward):
+            existing = self.by_port.get(key)
+            if existing is not None and existing is not forward and existing not in clashing:
+                clashing.append(existing)
+                conflicts.append(ForwardConflict('port', forward, existing))
+        existing = self.by_name.get(forward.name.unescaped)
+        if existing is not None and existing is not forward:
+            conflicts.append(ForwardConflict('name', forward, existing))
+        return conflicts
+    
+    def add(self, forward):
+        """Adds *forward*, raises `ValueError` if it conflicts with another one"""
+        conflicts = self.find_conflicts(forward)
+        if conflicts:
+            raise ValueError("{} conflicts with {}".format(
+                repr(forward), ", ".join(repr(conflict.existing) for conflict in conflicts)))
+        self.forwards.append(forward)
+        self.index(forward)
+    
+    def remove(self, forward):
+        """Removes *forward*, raises `KeyError` if it's not there"""
+        if forward not in self.forwards:
+            raise KeyError("{} is not on the list".format(repr(forward)))
+        self.forwards.remove(forward)
+        self.unindex(forward)
+    
+    def index(self, forward):
+        for key in self.port_keys(forward):
+            self.by_port.setdefault(key, forward)
+        self.by_name.setdefault(forward.name.unescaped, forward)
+    
+    def unindex(self, forward):
+        """Drops *forward* from the indexes, the slots it held go to the
+        first other forward taking the same port or name
+        """
+        for key in self.port_keys(forward):
+            if self.by_port.get(key) is forward:
+                del self.by_port[key]
+                for other in self.forwards:
+                    if other is not forward and key in self.port_keys(other):
+                        self.by_port[key] = other
+                        break
+        name = forward.name.unescaped
+        if self.by_name.get(name) is forward:
+            del self.by_name[name]
+            for other in self.forwards:
+                if other is not forward and other.name.unescaped == name:
+                    self.by_name[name] = other
+                    break
     
     @classmethod
     def from_nvram(cls, nvram, check_entries = True):
-        forwards = cls(nvram.get("forward_spec").decode("ascii"))
         if check_entries:
-            expected_forwards = int(nvram.get("forwardspec_entries").decode("ascii"))
+            values = nvram.get_many(["forward_spec", "forwardspec_entries"])
+            forwards = cls(values["forward_spec"].decode("ascii"))
+            expected_forwards = int(values["forwardspec_entries"].decode("ascii"))
             if len(forwards) != expected_forwards:
                 raise IOError("Expected to parse {} forwards, but instead parsed {}".format(
                     repr(expected_forwards), repr(len(forwards))))
+        else:
+            forwards = cls(nvram.get("forward_spec").decode("ascii"))
         
         return forwards
     
@@ -115,10 +239,110 @@ class ddwrt_forwards:
         nvram.set("forwardspec_entries", len(self))
     
     def __str__(self):
-        forward_spec = ""
-        for forward in self.forwards:
-            forward_spec += str(forward)
-        return forward_spec
+        return " ".join([str(forward) for forward in self.forwards])
     
     def __len__(self):
         return len(self.forwards)
+
+class ForwardTable:
+    """A compact, columnar version of `ddwrt_forwards` for large forward_spec
+    values. Names are kept escaped, states and protocols as the small 
+    integers of `State` and `Protocol`, ports and IPs as integers in arrays.
+    Rows are only turned into `PortForward` objects when they're accessed
+    """
+    __slots__ = ('names', 'states', 'protos', 'from_ports', 'to_ips', 'to_ports', 'from_ips')
+    states_by_name = {"on": 1, "off": 0}
+    protos_by_name = {"tcp": 1, "udp": 2, "both": 0}
+    
+    def __init__(self):
+        self.names = []
+        self.states = array('B')
+        self.protos = array('B')
+        self.from_ports = array('H')
+        self.to_ips = array('I')
+        self.to_ports = array('H')
+        self.from_ips = []
+    
+    @classmethod
+    def from_forward_spec(cls, forward_spec_string):
+        """Parses a whole forward_spec nvram string"""
+        table = cls()
+        for forward in forward_spec_string.split(" "):
+            if forward:
+                table.append_escaped(*split_forward_spec(forward))
+        return table
+    
+    @classmethod
+    def from_forwards(cls, forwards):
+        """Builds a table out of an iterable of `PortForward` (or a `ddwrt_forwards`)"""
+        if isinstance(forwards, ddwrt_forwards):
+            forwards = forwards.forwards
+        table = cls()
+        for forward in forwards:
+            table.append_escaped(forward.name.escaped, int(forward.state), int(forward.proto), 
+                                 int(forward.from_port), forward.to_ip, int(forward.to_port), 
+                                 None if forward.from_ip is None else str(forward.from_ip))
+        return table
+    
+    def append_escaped(self, name, state, proto, from_port, to_ip, to_port, from_ip = None):
+        """Adds a row, *state* and *proto* can be given by name or as integers.
+        Raises `ValueError` if a port is out of range, the way `Port` does
+        """
+        if isinstance(state, str):
+            if state.lower() not in self.states_by_name:
+                raise ValueError("{} is not a valid state".format(repr(state)))
+            state = self.states_by_name[state.lower()]
+        if isinstance(proto, str):
+            if proto.lower() not in self.protos_by_name:
+                raise ValueError("{} is not a valid protocol".format(repr(proto)))
+            proto = self.protos_by_name[proto.lower()]
+        from_port = int(Port(from_port))
+        to_port = int(Port(to_port))
+        to_ip = int(ipaddress.IPv4Address(to_ip))
+        self.names.append(name)
+        self.states.append(state)
+        self.protos.append(proto)
+        self.from_ports.append(from_port)
+        self.to_ips.append(to_ip)
+        self.to_ports.append(to_port)
+        self.from_ips.append(from_ip)
+    
+    def unescaped_names(self):
+        """Returns the names of every row, unescaped"""
+        return httpd_filter_names(self.names, True)
+    
+    def to_forwards(self):
+        """Returns a list of `PortForward`, one per row"""
+        return [self[row] for row in range(len(self))]
+    
+    def __getitem__(self, row):
+        return PortForward(self.names[row], self.states[row], Protocol.names[self.protos[row]], 
+                           self.to_ports[row], self.to_ips[row], self.from_ports[row], 
+                           True, self.from_ips[row])
+    
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
+    
+    def __len__(self):
+        return len(self.names)
+    
+    def __str__(self):
+        """Serializes the table back into a forward_spec string"""
+        states = ("off", "on")
+        forwards = []
+        for name, state, proto, from_port, to_ip, to_port, from_ip in zip(
+                self.names, self.states, self.protos, self.from_ports, 
+                self.to_ips, self.to_ports, self.from_ips):
+            forward = "{}:{}:{}:{}>{}:{}".format(name, states[state], Protocol.names[proto], 
+                                                 from_port, ipaddress.IPv4Address(to_ip), to_port)
+            if from_ip is not None:
+                forward += "<" + from_ip
+            forwards.append(forward)
+        return " ".join(forwards)
+    
+    def write_to_nvram(self, nvram):
+        """Saves the forwards into the router's nvram (without committing)
+        """
+        nvram.set("forward_spec", str(self))
+        nvram.set("forwardspec_entries", len(self))
@@ -0,0 +1,557 @@
+import re
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from nvram import NVRAM_Codec, as_bytes
+
+class ShellExit(Exception):
+    def __init__(self, status):
+        self.status = status
+
+class SimulatedRouter:
+    """An in-process stand-in for a DD-WRT router, used as a reproducible
+    target for tests and benchmarks. It understands the small subset of
+    `sh` this library sends (`;`, `&&`, `||`, pipes, `{ }` groups,
+    redirections, `$?` and plain variables) along with the `nvram`,
+    `echo`, `printf`, `cat`, `rm`, `grep`, `md5sum` and `stty` commands.
+    The nvram dictionary follows the semantics of the real `nvram` tool,
+    including splitting `nvram set` arguments at the first `=` and the
+    binary backup format.
+    """
+    banner = b"DD-WRT v3.0-r00000 std (c) 2016 NewMedia-NET GmbH\r\n"
+    """What the router prints when a pty is requested"""
+    nvram_size = 65536
+    """Bytes the `key=value` pairs can take, `nvram set` fails past it"""
+
+    def __init__(self, nvram = None, latency = 0.0, bandwidth = None, hostname = 'simulated', unsupported = ()):
+        """:nvram: The initial nvram dictionary
+        :latency: Seconds every round trip (an exec, or a write to a shell)
+        takes
+        :bandwidth: Bytes per second the router can send or receive, `None`
+        for no limit
+        :hostname: What the transport reports as the peer's address
+        :unsupported: Names of commands the router doesn't have, to exercise
+        the fallbacks of `ddwrt_ssh`
+        """
+        self.nvram = OrderedDict((as_bytes(key), as_bytes(value)) for key, value in (nvram or {}).items())
+        self.committed = OrderedDict(self.nvram)
+        self.files = {}
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.hostname = hostname
+        self.unsupported = set(unsupported)
+        self.codec = NVRAM_Codec()
+        self.lock = threading.RLock()
+        self.round_trips = 0
+        self.commands = []
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def client(self):
+        """Returns a new `SimulatedClient` connected to this router"""
+        return SimulatedClient(self)
+
+    def round_trip(self):
+        with self.lock:
+            self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def transfer(self, size, sent = True):
+        with self.lock:
+            if sent:
+                self.bytes_sent += size
+            else:
+                self.bytes_received += size
+        if self.bandwidth:
+            time.sleep(size / self.bandwidth)
+
+    def execute(self, script, stdin = b'', channel = None, shell = None):
+        """Runs *script* on *shell* (a new one if `None`), returns
+        `(stdout, stderr, status)`
+        """
+        with self.lock:
+            self.commands.append(script)
+            if shell is None:
+                shell = SimulatedShell(self, channel)
+            return shell.run(script, stdin)
+
+class SimulatedShell:
+    """Interprets a script on a `SimulatedRouter`"""
+    token_pattern = re.compile(r"""(?P<space>[ \t]+)|(?P<operator>&&|\|\||>>|>&2|2>&1|2>|;|\||>|<|\n)|"""
+                               r"""'(?P<single>[^']*)'|"(?P<double>[^"]*)"|\\(?P<escaped>.)|"""
+                               r"""(?P<plain>(?:[^ \t;&|<>'"\\\n]|&(?!&))+)""", re.S)
+    variable_pattern = re.compile(r"\$(\?|[A-Za-z_][A-Za-z0-9_]*)")
+
+    def __init__(self, router, channel = None):
+        self.router = router
+        self.channel = channel
+        self.variables = {'?': '0'}
+        self.exited = False
+
+    def run(self, script, stdin = b''):
+        stdout = bytearray()
+        stderr = bytearray()
+        if self.exited:
+            return b'', b'', int(self.variables['?'])
+        try:
+            status = self.run_list(self.parse(self.tokenize(script)), stdin, stdout, stderr)
+        except ShellExit as exit:
+            status = exit.status
+            self.variables['?'] = str(status)
+            self.exited = True
+        return bytes(stdout), bytes(stderr), status
+
+    def tokenize(self, script):
+        """Splits *script* into operators and words, every word is a list
+        of `(text, expandable)` parts so quoted text is never expanded
+        """
+        tokens = []
+        word = None
+        position = 0
+        for match in self.token_pattern.finditer(script):
+            if match.start() != position:
+                break
+            position = match.end()
+            kind = match.lastgroup
+            if kind == 'space' or kind == 'operator':
+                if word is not None:
+                    tokens.append(word)
+                    word = None
+                if kind == 'operator':
+                    tokens.append(match.group(kind))
+                continue
+            if word is None:
+                word = []
+            word.append((match.group(kind), kind == 'plain' or kind == 'double'))
+        if position != len(script):
+            raise ValueError("Can't parse {}".format(repr(script[position:])))
+        if word is not None:
+            tokens.append(word)
+        return tokens
+
+    def parse(self, tokens):
+        """Returns a list of `(connector, pipeline)` where connector is
+        `;`, `&&` or `||` and every pipeline a list of commands
+        """
+        items, rest = self.parse_list(tokens, 0)
+        if rest != len(tokens):
+            raise ValueError("Unexpected token {}".format(repr(tokens[rest])))
+        return items
+
+    def parse_list(self, tokens, position):
+        items = []
+        connector = ';'
+        pipeline = []
+        while position < len(tokens):
+            token = tokens[position]
+            if token in (';', '\n', '&&', '||'):
+                if pipeline:
+                    items.append((connector, pipeline))
+                    pipeline = []
+                connector = ';' if token == '\n' else token
+                position += 1
+            elif token == '|':
+                position += 1
+            elif token == [('}', True)]:
+                break
+            else:
+                command, position = self.parse_command(tokens, position)
+                pipeline.append(command)
+        if pipeline:
+            items.append((connector, pipeline))
+        return items, position
+
+    def parse_command(self, tokens, position):
+        words = []
+        redirects = []
+        group = None
+        if tokens[position] == [('{', True)]:
+            group, position = self.parse_list(tokens, position + 1)
+            position += 1
+        while position < len(tokens):
+            token = tokens[position]
+            if token in ('>', '>>', '<', '2>'):
+                redirects.append((token, tokens[position + 1]))
+                position += 2
+            elif token in ('>&2', '2>&1'):
+                redirects.append((token, None))
+                position += 1
+            elif isinstance(token, list) and group is None and token != [('}', True)]:
+                words.append(token)
+                position += 1
+            else:
+                break
+        return (group, words, redirects), position
+
+    def expand(self, word):
+        return "".join(self.variable_pattern.sub(lambda match: self.variables.get(match.group(1), ""), part)
+                       if expandable else part for part, expandable in word)
+
+    def run_list(self, items, stdin, stdout, stderr):
+        status = int(self.variables['?'])
+        for connector, pipeline in items:
+            if connector == '&&' and status != 0:
+                continue
+            if connector == '||' and status == 0:
+                continue
+            status = self.run_pipeline(pipeline, stdin, stdout, stderr)
+            self.variables['?'] = str(status)
+        return status
+
+    def run_pipeline(self, pipeline, stdin, stdout, stderr):
+        data = stdin
+        status = 0
+        for index, command in enumerate(pipeline):
+            output = bytearray()
+            status = self.run_command(command, data, output, stderr)
+            if index == len(pipeline) - 1:
+                stdout += output
+            data = bytes(output)
+        return status
+
+    def run_command(self, command, stdin, stdout, stderr):
+        group, words, redirects = command
+        output = bytearray()
+        errors = bytearray()
+        for operator, target in redirects:
+            if operator == '<':
+                stdin = self.read_file(self.expand(target))
+                if stdin is None:
+                    stderr += "sh: can't open {}\n".format(self.expand(target)).encode()
+                    return 1
+        if group is not None:
+            status = self.run_list(group, stdin, output, errors)
+        else:
+            args = [self.expand(word) for word in words]
+            status = self.builtin(args, stdin, output, errors)
+        for operator, target in redirects:
+            if operator in ('>', '>>'):
+                self.write_file(self.expand(target), bytes(output), operator == '>>', stdout)
+                output = bytearray()
+            elif operator == '2>':
+                self.write_file(self.expand(target), bytes(errors), False, stdout)
+                errors = bytearray()
+            elif operator == '>&2':
+                errors += output
+                output = bytearray()
+            elif operator == '2>&1':
+                output += errors
+                errors = bytearray()
+        stdout += output
+        stderr += errors
+        return status
+
+    def read_file(self, path):
+        if path == '/dev/null':
+            return b''
+        return self.router.files.get(path)
+
+    def write_file(self, path, data, append, stdout):
+        if path == '/dev/null':
+            return
+        if path in ('/dev/tty', '/dev/stdout'):
+            stdout += data
+        elif append:
+            self.router.files[path] = self.router.files.get(path, b'') + data
+        else:
+            self.router.files[path] = data
+
+    def builtin(self, args, stdin, stdout, stderr):
+        if not args:
+            return 0
+        name = args[0]
+        if '=' in name and name.split('=', 1)[0].isidentifier() and len(args) == 1:
+            variable, value = name.split('=', 1)
+            self.variables[variable] = value
+            return 0
+        handler = getattr(self, 'command_' + name, None)
+        if name == ':' or name == 'true':
+            return 0
+        if name == 'false':
+            return 1
+        if handler is None or name in self.router.unsupported:
+            stderr += "sh: {}: not found\n".format(name).encode()
+            return 127
+        return handler(args[1:], stdin, stdout, stderr)
+
+    def command_exit(self, args, stdin, stdout, stderr):
+        raise ShellExit(int(args[0]) if args else int(self.variables['?']))
+
+    def command_echo(self, args, stdin, stdout, stderr):
+        newline = True
+        if args and args[0] == '-n':
+            newline = False
+            args = args[1:]
+        stdout += (" ".join(args) + ("\n" if newline else "")).encode()
+        return 0
+
+    def command_printf(self, args, stdin, stdout, stderr):
+        template = args[0].replace('\\n', '\n').replace('\\t', '\t').replace('\\\\', '\\')
+        values = list(args[1:])
+        output = ""
+        position = 0
+        while position < len(template):
+            char = template[position]
+            if char == '%' and position + 1 < len(template):
+                kind = template[position + 1]
+                if kind == '%':
+                    output += '%'
+                else:
+                    value = values.pop(0) if values else ''
+                    output += str(int(value or 0)) if kind == 'd' else value
+                position += 2
+            else:
+                output += char
+                position += 1
+        stdout += output.encode()
+        return 0
+
+    def command_cat(self, args, stdin, stdout, stderr):
+        if not args:
+            stdout += stdin
+            return 0
+        status = 0
+        for path in args:
+            data = self.read_file(path)
+            if data is None:
+                stderr += "cat: can't open '{}': No such file or directory\n".format(path).encode()
+                status = 1
+            else:
+                stdout += data
+        return status
+
+    def command_rm(self, args, stdin, stdout, stderr):
+        force = '-f' in args
+        status = 0
+        for path in args:
+            if path == '-f':
+                continue
+            if self.router.files.pop(path, None) is None and not force:
+                stderr += "rm: can't remove '{}': No such file or directory\n".format(path).encode()
+                status = 1
+        return status
+
+    def command_grep(self, args, stdin, stdout, stderr):
+        flags = [arg for arg in args if arg.startswith('-')]
+        pattern = re.compile([arg for arg in args if not arg.startswith('-')][0])
+        lines = [line for line in stdin.decode().splitlines(True) if pattern.search(line)]
+        if '-q' not in flags:
+            stdout += "".join(lines).encode()
+        return 0 if lines else 1
+
+    def command_md5sum(self, args, stdin, stdout, stderr):
+        stdout += "{}  -\n".format(hashlib.md5(stdin).hexdigest()).encode()
+        return 0
+
+    def command_stty(self, args, stdin, stdout, stderr):
+        if self.channel is not None and '-onlcr' in args:
+            self.channel.onlcr = False
+        return 0
+
+    def command_sh(self, args, stdin, stdout, stderr):
+        if args[:1] == ['-c']:
+            output, errors, status = SimulatedShell(self.router, self.channel).run(args[1], stdin)
+        elif args:
+            script = self.read_file(args[0])
+            if script is None:
+                stderr += "sh: can't open '{}'\n".format(args[0]).encode()
+                return 2
+            output, errors, status = SimulatedShell(self.router, self.channel).run(script.decode(), stdin)
+        else:
+            output, errors, status = SimulatedShell(self.router, self.channel).run(stdin.decode())
+        stdout += output
+        stderr += errors
+        return status
+
+    def nvram_used(self, without = None):
+        """Returns the bytes taken by every pair but the one of *without*"""
+        return sum(len(key) + len(value) + 2 for key, value in self.router.nvram.items() if key != without)
+
+    def command_nvram(self, args, stdin, stdout, stderr):
+        router = self.router
+        action = args[0] if args else ''
+        if action == 'get' and len(args) > 1:
+            key = args[1].encode()
+            if key in router.nvram:
+                stdout += router.nvram[key] + b"\n"
+        elif action == 'set' and len(args) > 1:
+            if '=' in args[1]:
+                key, value = args[1].encode().split(b'=', 1)
+                size = self.nvram_used(key) + len(key) + len(value) + 2
+                if size > router.nvram_size:
+                    stderr += b"nvram: no space left\n"
+                    return 1
+                router.nvram[key] = value
+        elif action == 'unset' and len(args) > 1:
+            router.nvram.pop(args[1].encode(), None)
+        elif action == 'commit':
+            router.committed = OrderedDict(router.nvram)
+        elif action == 'show':
+            for key, value in router.nvram.items():
+                stdout += key + b"=" + value + b"\n"
+            size = self.nvram_used()
+            stderr += "size: {} bytes ({} left)\n".format(size, router.nvram_size - size).encode()
+        elif action == 'backup' and len(args) > 1:
+            self.write_file(args[1], router.codec.encode(router.nvram), False, stdout)
+        elif action == 'restore' and len(args) > 1:
+            data = self.read_file(args[1])
+            try:
+                router.nvram = router.codec.decode(data)
+            except Exception as error:
+                stderr += "restore failed: {}\n".format(error).encode()
+                return 1
+        else:
+            stderr += b"usage: nvram [get name] [set name=value] [unset name] [show] [commit] [backup file] [restore file]\n"
+            return 1
+        return 0
+
+class SimulatedChannel:
+    """The paramiko `Channel` surface used by `ddwrt_ssh`. A command runs
+    once its stdin is shut or its output is first read, while every write
+    to an `sh` channel runs right away as a script on the same shell
+    """
+    def __init__(self, router, get_pty = False):
+        self.router = router
+        self.get_pty = get_pty
+        self.onlcr = get_pty
+        self.command = None
+        self.shell = None
+        self.stdin = bytearray()
+        self.stdout = bytearray()
+        self.stderr = bytearray()
+        self.status = None
+        self.closed = False
+
+    def exec_command(self, command):
+        self.router.round_trip()
+        self.command = command
+        if command.strip() == 'sh':
+            self.shell = SimulatedShell(self.router, self)
+        if self.get_pty:
+            self.stdout += self.router.banner
+
+    def sendall(self, data):
+        data = as_bytes(data)
+        self.router.transfer(len(data), False)
+        if self.shell is not None:
+            self.router.round_trip()
+            stdout, stderr, status = self.router.execute(data.decode(), b'', self, self.shell)
+            self.stdout += stdout
+            self.stderr += stderr
+        else:
+            self.stdin += data
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def shutdown_write(self):
+        self.finish()
+
+    def finish(self):
+        if self.status is None and self.shell is None and self.command is not None:
+            stdout, stderr, status = self.router.execute(self.command, bytes(self.stdin), self)
+            if self.onlcr:
+                stdout = stdout.replace(b"\n", b"\r\n")
+            self.stdout += stdout
+            self.stderr += stderr
+            self.status = status
+
+    def recv(self, size):
+        self.finish()
+        data = bytes(self.stdout[:size])
+        del self.stdout[:size]
+        self.router.transfer(len(data))
+        return data
+
+    def recv_stderr(self, size):
+        self.finish()
+        data = bytes(self.stderr[:size])
+        del self.stderr[:size]
+        return data
+
+    def recv_ready(self):
+        self.finish()
+        return bool(self.stdout)
+
+    def recv_stderr_ready(self):
+        self.finish()
+        return bool(self.stderr)
+
+    def exit_status_ready(self):
+        self.finish()
+        return self.status is not None
+
+    def recv_exit_status(self):
+        self.finish()
+        return -1 if self.status is None else self.status
+
+    def settimeout(self, timeout):
+        pass
+
+    def close(self):
+        self.closed = True
+
+class SimulatedFile:
+    """The paramiko `ChannelFile` surface used by `ddwrt_ssh`"""
+    def __init__(self, channel, stream = 'stdout'):
+        self.channel = channel
+        self.stream = stream
+
+    def read(self, size = None):
+        recv = self.channel.recv_stderr if self.stream == 'stderr' else self.channel.recv
+        if size is None or size < 0:
+            data = bytearray()
+            while True:
+                chunk = recv(32768)
+                if not chunk:
+                    return bytes(data)
+                data += chunk
+        return recv(size)
+
+    def write(self, data):
+        self.channel.sendall(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.stream == 'stdin':
+            self.channel.shutdown_write()
+
+class SimulatedTransport:
+    def __init__(self, router):
+        self.router = router
+
+    def open_session(self, window_size = None, max_packet_size = None, timeout = None):
+        return SimulatedChannel(self.router)
+
+    def getpeername(self):
+        return (self.router.hostname, 22)
+
+    def is_active(self):
+        return True
+
+class SimulatedClient:
+    """The paramiko `SSHClient` surface used by `ddwrt_ssh`, connected to
+    a `SimulatedRouter`
+    """
+    def __init__(self, router):
+        self.router = router
+        self.transport = SimulatedTransport(router)
+
+    def exec_command(self, command, bufsize = -1, timeout = None, get_pty = False, environment = None):
+        channel = SimulatedChannel(self.router, get_pty)
+        channel.exec_command(command)
+        return SimulatedFile(channel, 'stdin'), SimulatedFile(channel), SimulatedFile(channel, 'stderr')
+
+    def get_transport(self):
+        return self.transport
+
+    def open_sftp(self):
+        raise IOError("The simulated router has no sftp subsystem")
+
+    def close(self):
+        pass
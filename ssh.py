@@ -1,27 +1,164 @@
 
 import shlex
+import uuid
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from metrics import instrumented
+
+CommandResult = namedtuple('CommandResult', ['stdout', 'stderr', 'status'])
+"""The output of a command ran with `ddwrt_ssh.run`"""
+
+def command_size(result, command, *args):
+    return len(command)
+
+def commands_size(results, commands, *args):
+    return sum(len(command) for command in commands)
+
+def result_size(result, *args):
+    return len(result.stdout) + len(result.stderr)
+
+def results_size(results, *args):
+    return sum(len(result.stdout) + len(result.stderr) for result in results)
+
+class CommandError(IOError):
+    """Raised when a command checked by `ddwrt_ssh.run` exits with a non 
+    zero status"""
+    def __init__(self, command, result):
+        super().__init__("{} exited with status {}: {}".format(
+            repr(command), repr(result.status), repr(result.stderr)))
+        self.command = command
+        self.result = result
+
+class ddwrt_shell():
+    """Keeps a single `sh` session open on the router and runs commands by
+    writing them to its stdin, saving the channel setup and the shell fork
+    every exec costs. The output of every command is followed by a unique 
+    sentinel carrying its exit status, so many commands can be written at 
+    once and their replies read afterwards.
+    """
+    def __init__(self, paramiko_client, bufsize = 32768, pipeline_depth = 64):
+        """:paramiko_client: a `paramiko.client.SSHCient` instance
+        :bufsize: How much to read from the channel at once
+        :pipeline_depth: How many commands are written before reading their
+        replies, this keeps the shell from stalling on a full channel window
+        """
+        stdin, stdout, stderr = paramiko_client.exec_command("sh")
+        self.stdin = stdin
+        self.channel = stdout.channel
+        self.bufsize = bufsize
+        self.pipeline_depth = pipeline_depth
+        self.stdout_buffer = b''
+        self.stderr_buffer = b''
+        self.lock = threading.Lock()
+    
+    def run(self, command, timeout = None):
+        """Runs *command* on the shell, returns a `CommandResult`"""
+        return self.run_many([command], timeout)[0]
+    
+    def run_many(self, commands, timeout = None):
+        """Writes every command in *commands* to the shell in one go and then
+        collects their replies, returns a list of `CommandResult`
+        """
+        commands = list(commands)
+        results = []
+        with self.lock:
+            try:
+                self.channel.settimeout(timeout)
+                for start in range(0, len(commands), self.pipeline_depth):
+                    tokens = []
+                    script = ""
+                    for command in commands[start : start + self.pipeline_depth]:
+                        token = uuid.uuid4().hex
+                        tokens.append(token)
+                        script += ("{{ {}\n}} </dev/null\n"
+                                   "printf '{} %d\\n' $?\n"
+                                   "printf '{}\\n' >&2\n").format(command, token, token)
+                    self.stdin.write(script)
+                    self.stdin.flush()
+                    results += [self.collect(token.encode()) for token in tokens]
+            except Exception:
+                #the replies still on their way would be taken for the
+                #ones of the next commands, so the shell can't be reused
+                self.close()
+                raise
+        return results
+    
+    def collect(self, token):
+        stdout, status_line = self.read_until(token, False)
+        stderr = self.read_until(token + b'\n', True)[0]
+        return CommandResult(stdout, stderr, int(status_line))
+    
+    def read_until(self, token, from_stderr):
+        """Reads from stdout (or stderr) until *token* is found, returns
+        `(output, line)` where *output* is everything before the token and 
+        *line* the rest of the line it was found in
+        """
+        buffer = self.stderr_buffer if from_stderr else self.stdout_buffer
+        recv = self.channel.recv_stderr if from_stderr else self.channel.recv
+        while True:
+            position = buffer.find(token)
+            if position != -1:
+                end = buffer.find(b'\n', position + len(token) - 1)
+                if end != -1:
+                    break
+            data = recv(self.bufsize)
+            if not data:
+                raise IOError("The shell exited before the command finished")
+            buffer += data
+        output, line = buffer[:position], buffer[position + len(token) : end]
+        if from_stderr:
+            self.stderr_buffer = buffer[end + 1:]
+        else:
+            self.stdout_buffer = buffer[end + 1:]
+        return output, line
+    
+    def close(self):
+        self.stdout_buffer = b''
+        self.stderr_buffer = b''
+        self.channel.close()
+
 class ddwrt_ssh():
     """A small wrapper for paramaiko's SSHClient, it supplies most
      of the ssh sppecific functions needed to operate on the router 
     via this medium
     """
-    def __init__(self, paramiko_client, get_header_now = False):
+    transfer_methods = {}
+    """The transfer method detected for every host, see `.transfer_method`"""
+    binary_probe = bytes(range(256)) + b"\r\n\n\r\x00\x00"
+    """Sent through `cat` by `.transfer_method` to tell if raw channels are
+    binary safe, every byte value along with the ones a tty would mangle"""
+    window_size = 2 ** 24
+    """The window size of the channels used for binary transfers"""
+    metrics = None
+    """A sink (see `metrics.AggregateSink`) every command and transfer is
+    reported to, set it on the class to instrument every router"""
+    
+    def __init__(self, paramiko_client, get_header_now = False, max_channels = 4, persistent_shell = False):
         """:paramiko_client: a `paramiko.client.SSHCient` instance
         :get_header_now: `True` if the header for `.chop_header` needs
         to be fetched manually instead of being initialized by `.pipe_to_stdin`
+        :max_channels: The maximum number of channels `.run` and `.run_many`
+        will keep open at the same time on the connection
+        :persistent_shell: Run the commands given to `.run` and `.run_many`
+        through a single long lived `ddwrt_shell` instead of a channel each
         """
         self.client = paramiko_client
+        self.max_channels = max_channels
+        self.channels = threading.BoundedSemaphore(max_channels)
+        self.shell = ddwrt_shell(paramiko_client) if persistent_shell else None
+        self.sftp = None
         if get_header_now:
-            self.get_header()
+            self.fetch_header()
         else:
             self.header_length = None
-        pass
     
+    @instrumented("ssh.pipe_to_stdin", bytes_out = command_size)
     def pipe_to_stdin(self, command, bufsize = -1, timeout = None):
         """Requests a pty along with some parameters to avoid data loss
         caused by the use of a pseudo-terminal, it's safe to use /dev/tty
         here. Keep in mind that sometimes it might be safer to use sftp
-        and temporary files.
+        and temporary files, see `.iter_file_from` and `.send_file_to`.
         """
         if self.header_length is None: self.fetch_header()
         dont_replace_newline = "stty -onlcr"    #the 'stty -onlcr' command should
@@ -32,6 +169,226 @@ class ddwrt_ssh():
         return self.client.exec_command("{}; {}".format(
             dont_replace_newline, command), get_pty =  True, bufsize = bufsize, timeout = timeout)
     
+    @instrumented("ssh.iter_pipe")
+    def iter_pipe(self, command, chunk_size = 32768, timeout = None):
+        """Runs *command* the same way `.pipe_to_stdin` does, but yields its
+        stdout in chunks of up to *chunk_size* bytes as they arrive, with 
+        the header already chopped. Raises `CommandError` if it exits with
+        a non zero status
+        """
+        stdout = self.pipe_to_stdin(command, timeout = timeout)[1]
+        skip = self.header_length
+        while True:
+            chunk = stdout.read(chunk_size)
+            if not chunk:
+                break
+            if skip:
+                dropped = min(skip, len(chunk))
+                chunk = chunk[dropped:]
+                skip -= dropped
+                if not chunk:
+                    continue
+            yield chunk
+        status = stdout.channel.recv_exit_status()
+        self.check_results([command], [CommandResult(b'', b'', status)], True)
+    
+    @instrumented("ssh.run", result_size, command_size)
+    def run(self, command, check = False, timeout = None):
+        """Runs *command* on its own channel, waits for it to finish and 
+        returns a `CommandResult` with its stdout, stderr and exit status. 
+        No more than `max_channels` commands run at the same time.
+        :check: Raise `CommandError` if the command exits with a non zero status
+        """
+        if self.shell is not None:
+            return self.check_results([command], self.run_on_shell([command], timeout), check)[0]
+        return self.feed_stdin(command, None, check, timeout)
+    
+    @instrumented("ssh.run_many", results_size, commands_size)
+    def run_many(self, commands, check = False, timeout = None):
+        """Runs every command in *commands* in parallel over the same 
+        connection (bounded by `max_channels`), or pipelined through the
+        persistent shell if there's one. Returns a list of `CommandResult`
+        in the same order
+        """
+        commands = list(commands)
+        if self.shell is not None:
+            return self.check_results(commands, self.run_on_shell(commands, timeout), check)
+        if len(commands) < 2:
+            return [self.run(command, check, timeout) for command in commands]
+        with ThreadPoolExecutor(min(self.max_channels, len(commands))) as executor:
+            return list(executor.map(lambda command: self.run(command, check, timeout), commands))
+    
+    def run_on_shell(self, commands, timeout = None):
+        """Runs *commands* through the persistent shell, if that fails (a
+        timeout, a dropped channel) the shell is closed so later commands
+        use a channel each instead of reading stale replies
+        """
+        try:
+            return self.shell.run_many(commands, timeout)
+        except Exception:
+            self.close_shell()
+            raise
+    
+    def feed_stdin(self, command, write, check = False, timeout = None):
+        """Runs *command* without a pty (so binary data is safe) and calls 
+        *write* with its stdin, which gets closed afterwards. Returns a
+        `CommandResult` the same way `.run` does
+        """
+        with self.channels:
+            stdin, stdout, stderr = self.client.exec_command(command, timeout = timeout)
+            if write is not None:
+                write(stdin)
+                stdin.flush()
+            stdin.channel.shutdown_write()
+            result = CommandResult(stdout.read(), stderr.read(), stdout.channel.recv_exit_status())
+        return self.check_results([command], [result], check)[0]
+    
+    def check_results(self, commands, results, check):
+        if check:
+            for command, result in zip(commands, results):
+                if result.status != 0:
+                    raise CommandError(command, result)
+        return results
+    
+    def transfer_method(self):
+        """Returns the mechanism used to move binary files to and from the
+        router, detected once per host:
+        
+            'exec'  a raw channel without a pty, with a large window, using `cat`
+            'sftp'  the router's sftp subsystem
+            'pty'   the old `.pipe_to_stdin` path writing to /dev/tty, only
+                    for downloads, uploads raise `IOError`
+        
+        The result isn't remembered if the probe failed with an exception
+        instead of an answer, so a passing glitch doesn't downgrade the host
+        """
+        host = self.host_key()
+        if host in self.transfer_methods:
+            return self.transfer_methods[host]
+        try:
+            binary_safe = self.probe_binary()
+            probed = True
+        except Exception:
+            binary_safe = probed = False
+        if binary_safe:
+            method = 'exec'
+        else:
+            try:
+                self.open_sftp()
+                method = 'sftp'
+            except Exception:
+                method = 'pty'
+        if probed:
+            self.transfer_methods[host] = method
+        return method
+    
+    def probe_binary(self):
+        """Returns whether `binary_probe` makes it through `cat` on a channel
+        without a pty byte exact, both ways
+        """
+        result = self.feed_stdin("cat", lambda stdin: stdin.write(self.binary_probe), timeout = 30)
+        return result.status == 0 and result.stdout == self.binary_probe
+    
+    def host_key(self):
+        try:
+            return self.client.get_transport().getpeername()
+        except Exception:
+            return id(self.client)
+    
+    def open_sftp(self):
+        if self.sftp is None:
+            self.sftp = self.client.open_sftp()
+        return self.sftp
+    
+    def iter_file_from(self, command, path, chunk_size = 32768, tty_command = None):
+        """Runs *command*, which has to write *path* on the router, and 
+        yields the contents of that file in chunks of up to *chunk_size* 
+        bytes, byte exact. The file is removed afterwards.
+        :tty_command: The same command writing to /dev/tty instead, used on
+        hosts whose transfer method is 'pty'. `IOError` is raised on those
+        hosts if it's `None`
+        """
+        method = self.transfer_method()
+        quoted = self.quote(path)
+        if method == 'sftp':
+            self.run(command, check = True)
+            try:
+                with self.open_sftp().open(path, 'rb') as remote:
+                    remote.prefetch()
+                    while True:
+                        chunk = remote.read(chunk_size)
+                        if not chunk:
+                            break
+                        yield chunk
+            finally:
+                self.run("rm -f {}".format(quoted))
+        elif method == 'exec':
+            script = "{1} && cat {0}; status=$?; rm -f {0}; exit $status".format(quoted, command)
+            for chunk in self.iter_raw(script, chunk_size):
+                yield chunk
+        else:
+            if tty_command is None:
+                raise IOError("{} has neither a binary safe channel nor sftp, "
+                              "the file can only be read through /dev/tty".format(repr(self.host_key())))
+            for chunk in self.iter_pipe(tty_command, chunk_size):
+                yield chunk
+    
+    @instrumented("ssh.send_file_to")
+    def send_file_to(self, path, write, command):
+        """Uploads a file to *path* on the router, *write* is called with a
+        file-like object to write its contents to. *command* is ran once
+        the upload is done, and the file removed afterwards. Returns the
+        `CommandResult` of *command*. Raises `IOError` if the host has
+        neither a binary safe channel nor sftp (the 'pty' transfer method)
+        """
+        quoted = self.quote(path)
+        method = self.transfer_method()
+        if method == 'pty':
+            raise IOError("Can't upload {} to {}, it has neither a binary safe channel nor sftp".format(
+                repr(path), repr(self.host_key())))
+        if method == 'sftp':
+            try:
+                with self.open_sftp().open(path, 'wb') as remote:
+                    remote.set_pipelined(True)
+                    write(remote)
+                return self.run(command, check = True)
+            finally:
+                self.run("rm -f {}".format(quoted))
+        else:
+            script = "cat > {0} && {1}; status=$?; rm -f {0}; exit $status".format(quoted, command)
+            return self.feed_stdin(script, write, check = True)
+    
+    @instrumented("ssh.iter_raw")
+    def iter_raw(self, command, chunk_size = 32768):
+        """Runs *command* on a channel without a pty and a large window, 
+        yields its stdout as it arrives. Raises `CommandError` if it exits 
+        with a non zero status
+        """
+        with self.channels:
+            channel = self.client.get_transport().open_session(window_size = self.window_size)
+            try:
+                channel.exec_command(command)
+                while True:
+                    chunk = channel.recv(chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+                stderr = b''
+                while channel.recv_stderr_ready():
+                    stderr += channel.recv_stderr(chunk_size)
+                status = channel.recv_exit_status()
+            finally:
+                channel.close()
+        self.check_results([command], [CommandResult(b'', stderr, status)], True)
+    
+    def close_shell(self):
+        """Closes the persistent shell, if any, later commands will use a
+        channel each
+        """
+        if self.shell is not None:
+            self.shell.close()
+            self.shell = None
+    
     def chop_header(self, string):
         return string[self.header_length:]
 
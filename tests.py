@@ -1,18 +1,26 @@
 import unittest
-import paramiko
+import socket
 
-from nvram import NVRAM, NVRAM_Codec
-from ssh import ddwrt_ssh
+from nvram import NVRAM, NVRAM_Codec, NVRAM_Snapshot, NVRAM_Cache, NVRAM_ReadCache, diff_nvram
+from ssh import ddwrt_ssh, CommandError
 class NVRAMTests(unittest.TestCase):
+    def connect(self):
+        try:
+            import paramiko
+        except ImportError:
+            self.skipTest("paramiko isn't installed")
+        client = paramiko.client.SSHClient()
+        client.set_missing_host_key_policy(paramiko.client.AutoAddPolicy())
+        client.load_system_host_keys()
+        client.connect(input("Hostname:> "), username = input("Username:> "))
+        return client
+    
     def setUp(self):
-        self.client = paramiko.client.SSHClient()
-        self.client.set_missing_host_key_policy(paramiko.client.AutoAddPolicy())
-        self.client.load_system_host_keys()
-        self.client.connect(input("Hostname:> "), username = input("Username:> "))
-        self.client.exec_command("nvram backup /tmp/nvram.bkp")
+        self.client = self.connect()
+        self.client.exec_command("nvram backup /tmp/nvram.bkp")[1].channel.recv_exit_status()
     
     def tearDown(self):
-        self.client.exec_command("nvram restore /tmp/nvram.bkp && rm /tmp/nvram.bkp")
+        self.client.exec_command("nvram restore /tmp/nvram.bkp && rm /tmp/nvram.bkp")[1].channel.recv_exit_status()
         self.client.close()
         
     def test_nvram(self):
@@ -20,10 +28,20 @@ class NVRAMTests(unittest.TestCase):
         key, value = ("!#$$$%&%>>><<<", "\n&&!!#$%&/\"")
         nvram.set(key, value)
         self.assertEqual(nvram.get(key).decode('ascii'), value)
+        self.assertEqual(nvram.get_many([key, "daljwnd21"]), {key: value.encode('ascii'), "daljwnd21": b''})
         nvram.unset(key)
         with self.assertRaises(KeyError):
             nvram.set("====", ":V")
     
+    def test_persistent_shell(self):
+        router = ddwrt_ssh(self.client, persistent_shell = True)
+        nvram = NVRAM(router)
+        nvram.set('key1', 'multi\nline')
+        self.assertEqual(nvram.get('key1'), b'multi\nline')
+        results = router.run_many(["echo out; echo err >&2", "false"])
+        self.assertEqual([tuple(result) for result in results], [(b'out\n', b'err\n', 0), (b'', b'', 1)])
+        router.close_shell()
+    
     def test_cache(self):
         nvram = NVRAM(ddwrt_ssh(self.client))
         nvram.enter_cache_mode()
@@ -41,7 +59,18 @@ class NVRAMTests(unittest.TestCase):
         self.assertEqual(nvram.get('key2'), b'value2')
         self.assertEqual(nvram.get('key3'), b'value3')
         self.assertEqual(nvram.get('key4'), b'value4')
-            
+    
+    def test_cache_restore(self):
+        nvram = NVRAM(ddwrt_ssh(self.client))
+        nvram.enter_cache_mode()
+        nvram.set('key1', 'value1')
+        nvram.unset('key2')
+        nvram.exit_cache_mode(as_changeset = False)
+        self.assertEqual(nvram.get('key1'), b'value1')
+        self.assertEqual(nvram.get('key2'), b'')
+        nvram.enter_cache_mode(fetch_all = False)
+        with self.assertRaises(ValueError):
+            nvram.exit_cache_mode(as_changeset = False)
         
 
     def test_codec(self):
@@ -53,8 +82,310 @@ class NVRAMTests(unittest.TestCase):
         self.assertEqual(decoded_twice, decoded)
         #self.assertEqual(encoded, memory) #this won't be equal if the backup has a duplicated key :'v
 
+import io
+import struct
+from collections import OrderedDict
+def make_backup(items, count = None):
+    """Builds a raw nvram backup out of a list of `(key, value)` pairs"""
+    backup = b'DD-WRT' + struct.pack('H', len(items) if count is None else count)
+    for key, value in items:
+        backup += struct.pack('B', len(key)) + key + struct.pack('H', len(value)) + value
+    return backup
+
+class CodecTests(unittest.TestCase):
+    items = [(b'lan_ipaddr', b'192.168.1.1'), (b'empty', b''), (b'multi', b'line\none')]
+
+    def test_decode(self):
+        codec = NVRAM_Codec()
+        decoded = codec.decode(make_backup(self.items))
+        self.assertEqual(list(decoded.items()), self.items)
+        self.assertEqual(codec.decode(bytearray(make_backup(self.items)), False), dict(self.items))
+        with self.assertRaises(IOError):
+            codec.decode(b'OpenWRT' + make_backup(self.items)[6:])
+        with self.assertRaises(IOError):
+            codec.decode(make_backup(self.items, 2))
+        with self.assertRaises(LookupError):
+            codec.decode(make_backup(self.items) + b'\x01')
+
+    def test_decode_duplicated(self):
+        codec = NVRAM_Codec()
+        duplicated = make_backup([(b'key', b'1'), (b'key', b'2')], 1)
+        self.assertEqual(codec.decode(duplicated), {b'key': b'2'})
+        with self.assertRaises(KeyError):
+            codec.decode(duplicated, allow_duplicated_key = False)
+
+    def test_encode(self):
+        codec = NVRAM_Codec()
+        encoded = codec.encode(OrderedDict(self.items))
+        self.assertEqual(encoded, make_backup(self.items))
+        self.assertIsInstance(encoded, bytes)
+        stream = io.BytesIO()
+        self.assertEqual(codec.encode_to(OrderedDict(self.items), stream, 8), len(encoded))
+        self.assertEqual(stream.getvalue(), encoded)
+        with self.assertRaises(ValueError):
+            codec.encode({b'k' * 256: b''})
+        with self.assertRaises(ValueError):
+            codec.encode({b'k': b'v' * 65536})
+
+    def test_decode_stream(self):
+        codec = NVRAM_Codec()
+        backup = make_backup(self.items)
+        for size in (1, 3, len(backup)):
+            chunks = [backup[start : start + size] for start in range(0, len(backup), size)]
+            self.assertEqual(codec.decode_stream(chunks), codec.decode(backup))
+        with self.assertRaises(LookupError):
+            codec.decode_stream([backup[:-1]])
+
+    def test_snapshot(self):
+        backup = make_backup(self.items + [(b'empty', b'now set')], 3)
+        snapshot = NVRAM_Snapshot(backup)
+        self.assertEqual(dict(snapshot), NVRAM_Codec().decode(backup))
+        self.assertEqual(snapshot['multi'], b'line\none')
+        self.assertEqual(snapshot.view(b'empty').tobytes(), b'now set')
+        self.assertNotIn(b'missing', snapshot)
+        with self.assertRaises(KeyError):
+            snapshot[b'missing']
+        cache = NVRAM_Cache(snapshot)
+        cache.unset(b'multi')
+        self.assertEqual(cache.get(b'lan_ipaddr'), b'192.168.1.1')
+        self.assertEqual(cache.get_snapshot(), OrderedDict(
+            [(b'lan_ipaddr', b'192.168.1.1'), (b'empty', b'now set')]))
+
+        items = OrderedDict((str(index).encode(), bytes(index % 7)) for index in range(3000))
+        snapshot = NVRAM_Snapshot(NVRAM_Codec().encode(items))
+        self.assertEqual(list(snapshot), list(items))
+        self.assertTrue(all(snapshot[key] == value for key, value in items.items()))
+        self.assertNotIn('3000', snapshot)
+
+    def test_cache_layers(self):
+        base = OrderedDict([(b'a', b'1'), (b'b', b'2')])
+        cache = NVRAM_Cache(base)
+        cache.set('c', 3)
+        before = cache.get_snapshot()
+        outer = cache.savepoint()
+        cache.unset('a')
+        cache.savepoint()
+        cache.set('a', 'again')
+        cache.set('b', '22')
+        cache.rollback()
+        self.assertEqual(cache.get('a'), b'')
+        self.assertEqual(cache.get('b'), b'2')
+        self.assertEqual(len(cache.get_snapshot()), 2)
+        cache.savepoint()
+        cache.set('d', '4')
+        cache.release()
+        cache.rollback(outer)
+        self.assertEqual(cache.get_changes(), ({b'c': b'3'}, []))
+        self.assertEqual(list(cache.get_snapshot().items()), [(b'a', b'1'), (b'b', b'2'), (b'c', b'3')])
+        self.assertEqual(dict(before), {b'a': b'1', b'b': b'2', b'c': b'3'})
+        self.assertEqual(base, OrderedDict([(b'a', b'1'), (b'b', b'2')]))
+        with self.assertRaises(LookupError):
+            cache.rollback()
+
+
+    def test_diff(self):
+        backup = make_backup(self.items)
+        desired = {'lan_ipaddr': '192.168.1.1', 'empty': 'full', 'new': 1, 'multi': None, 'gone': None}
+        for current in (NVRAM_Codec().decode(backup), NVRAM_Snapshot(backup)):
+            sets, unsets = diff_nvram(current, desired)
+            self.assertEqual((dict(sets), unsets), ({b'empty': b'full', b'new': b'1'}, [b'multi']))
+            sets, unsets = diff_nvram(current, {'lan_ipaddr': '192.168.1.1'}, unset_missing = True)
+            self.assertEqual((dict(sets), sorted(unsets)), ({}, [b'empty', b'multi']))
 
-from network_common import Port, Protocol, MAC_address, State, httpd_filter_name
+from concurrent.futures import ThreadPoolExecutor
+from simulator import SimulatedRouter
+class ReadCacheTests(unittest.TestCase):
+    def test_read_cache(self):
+        now = [0]
+        cache = NVRAM_ReadCache(ttl = 5, max_size = 2, ttls = {'slow': 60}, clock = lambda: now[0])
+        cache.put('fast', 'value')
+        cache.put(b'slow', b'value')
+        self.assertEqual(cache.get(b'fast'), b'value')
+        now[0] = 10
+        self.assertIsNone(cache.get('fast'))
+        self.assertEqual(cache.get('slow'), b'value')
+        cache.put('a', '1')
+        cache.put('b', '2')
+        self.assertEqual(cache.keys(), [b'a', b'b'])
+        cache.invalidate('a')
+        self.assertIsNone(cache.get('a'))
+
+    def test_commit(self):
+        router = SimulatedRouter({'key': 'value'})
+        nvram = NVRAM(ddwrt_ssh(router.client()), NVRAM_ReadCache())
+        nvram.get('key')
+        nvram.set('other', 'set')
+        nvram.commit()
+        start = router.round_trips
+        self.assertEqual(nvram.get_many(['key', 'other']), {'key': b'value', 'other': b'set'})
+        self.assertEqual(router.round_trips, start)
+
+    def test_threads(self):
+        cache = NVRAM_ReadCache(max_size = 64)
+        def work(offset):
+            for index in range(2000):
+                cache.put(str(offset + index % 100), index)
+                cache.get(str(offset + (index * 7) % 100))
+                if index % 10 == 0:
+                    cache.invalidate(str(offset + index % 100))
+                    cache.keys()
+        with ThreadPoolExecutor(4) as executor:
+            list(executor.map(work, range(0, 400, 100)))
+        self.assertLessEqual(len(cache.keys()), 64)
+
+import os
+import tempfile
+from datetime import datetime
+from archive import NVRAM_Archive
+class ArchiveTests(unittest.TestCase):
+    def test_archive(self):
+        with tempfile.TemporaryDirectory() as root:
+            archive = NVRAM_Archive(root)
+            archive.store('router1', make_backup([(b'wan_ipaddr', b'10.0.0.1')]), 100)
+            archive.store('router1', make_backup([(b'wan_ipaddr', b'10.0.0.2')]), 200)
+            archive.store('router2', make_backup([(b'lan_ipaddr', b'10.0.1.1')]), 150)
+            self.assertEqual(archive.hosts(), ['router1', 'router2'])
+            self.assertEqual(archive.lookup('router1', 'wan_ipaddr', 150), b'10.0.0.1')
+            self.assertEqual(archive.lookup('router1', 'wan_ipaddr', datetime.fromtimestamp(250)), b'10.0.0.2')
+            self.assertIsNone(archive.lookup('router1', 'wan_ipaddr', 50))
+            self.assertEqual(list(archive.iter_key(b'wan_ipaddr')), [
+                ('router1', 100, b'10.0.0.1'), ('router1', 200, b'10.0.0.2'), ('router2', 150, None)])
+            with archive.open('router2', 150) as backup:
+                self.assertEqual(NVRAM_Codec().decode(backup.raw()), {b'lan_ipaddr': b'10.0.1.1'})
+            for host in ('../outside', 'a/b', '..', ''):
+                with self.assertRaises(ValueError):
+                    archive.store(host, make_backup([]), 100)
+            with self.assertRaises(FileExistsError):
+                archive.store('router1', make_backup([(b'wan_ipaddr', b'10.0.0.3')]), 200)
+            self.assertEqual(archive.lookup('router1', 'wan_ipaddr'), b'10.0.0.2')
+            for stray in ('notes.bkp', '-5.bkp', '.bkp'):
+                open(os.path.join(root, 'router1', stray), 'wb').close()
+            self.assertEqual(archive.timestamps('router1'), [100, 200])
+
+    def test_index(self):
+        items = [(str(index).encode(), str(index * 3).encode()) for index in range(500, 0, -1)]
+        with tempfile.TemporaryDirectory() as root:
+            archive = NVRAM_Archive(root)
+            archive.store('router', make_backup(items), 100)
+            with archive.open('router', 100) as backup:
+                self.assertEqual(list(backup), [key for key, value in items])
+                self.assertTrue(all(backup[key] == value for key, value in items))
+                self.assertNotIn(b'0', backup)
+                self.assertNotIn(b'5000', backup)
+            backup_path, index_path = archive.paths('router', 100)
+            os.remove(index_path)
+            self.assertEqual(archive.lookup('router', '250'), b'750')
+            self.assertTrue(os.path.exists(index_path))
+
+from fingerprint import NVRAM_Fingerprints
+class FingerprintTests(unittest.TestCase):
+    def test_decode(self):
+        fingerprints = NVRAM_Fingerprints()
+        first, changed = fingerprints.decode('router', make_backup([(b'key', b'1')]))
+        self.assertTrue(changed)
+        second, changed = fingerprints.decode('router', make_backup([(b'key', b'1')]))
+        self.assertFalse(changed)
+        self.assertIs(first, second)
+        third, changed = fingerprints.decode('router', make_backup([(b'key', b'2')]))
+        self.assertEqual((third, changed), ({b'key': b'2'}, True))
+
+    def test_remote(self):
+        router = SimulatedRouter({'key': '1'})
+        nvram = NVRAM(ddwrt_ssh(router.client()))
+        fingerprints = NVRAM_Fingerprints()
+        self.assertEqual(len(fingerprints.remote_fingerprint(nvram)), 32)
+        router.unsupported.add('nvram')
+        self.assertIsNone(fingerprints.remote_fingerprint(nvram))
+
+from leases import Lease, ddwrt_leases, LeaseTable
+from port_forwarding import Name, PortForward, ddwrt_forwards, ForwardTable
+class TableTests(unittest.TestCase):
+    leases = "00:11:22:33:44:55=host1=192.168.1.5= AA:BB:CC:DD:EE:FF=host2=192.168.1.6= "
+    forwards = "web&nbsp;server:on:tcp:80>192.168.1.10:8080 dns:off:both:53>192.168.1.2:53<10.0.0.0/8"
+
+    def test_leases(self):
+        table = LeaseTable.from_static_leases(self.leases)
+        self.assertEqual(len(table), 2)
+        self.assertEqual(int(table[1].mac), 0xAABBCCDDEEFF)
+        self.assertEqual(str(table), self.leases)
+        self.assertEqual(str(ddwrt_leases(self.leases)), self.leases)
+        self.assertEqual(str(LeaseTable.from_leases(ddwrt_leases(self.leases))), self.leases)
+
+    def test_lease_indexes(self):
+        leases = ddwrt_leases(self.leases)
+        self.assertEqual(leases.find_by_mac("aa:bb:cc:dd:ee:ff").hostname, "host2")
+        self.assertEqual(leases.find_by_ip("192.168.1.5").hostname, "host1")
+        self.assertIs(leases.find_by_hostname("host2"), leases.find_by_mac(0xAABBCCDDEEFF))
+        with self.assertRaises(ValueError):
+            leases.add(Lease("00:11:22:33:44:55", "host3", "192.168.1.7"))
+        leases.upsert(Lease("00:11:22:33:44:55", "host1", "192.168.1.7"))
+        self.assertIsNone(leases.find_by_ip("192.168.1.5"))
+        self.assertEqual(leases.find_by_ip("192.168.1.7").hostname, "host1")
+        conflicts = leases.bulk_import([Lease("00:00:00:00:00:01", "a", "192.168.1.6"),
+                                        Lease("00:00:00:00:00:02", "b", "192.168.1.8"),
+                                        Lease("00:00:00:00:00:02", "c", "192.168.1.9")])
+        self.assertEqual([(conflict.kind, conflict.lease.hostname) for conflict in conflicts], 
+                         [('ip', 'a'), ('mac', 'c')])
+        leases.remove("00:00:00:00:00:02")
+        self.assertEqual(len(leases), 2)
+        with self.assertRaises(KeyError):
+            leases.remove("00:00:00:00:00:02")
+
+        leases = ddwrt_leases("00:00:00:00:00:01=pc=10.0.0.1= 00:00:00:00:00:02=pc=10.0.0.2= ")
+        leases.remove("00:00:00:00:00:01")
+        self.assertEqual(str(leases.find_by_hostname("pc").ip), "10.0.0.2")
+        leases.upsert(Lease("00:00:00:00:00:02", "desktop", "10.0.0.2"))
+        self.assertIsNone(leases.find_by_hostname("pc"))
+
+    def test_forwards(self):
+        table = ForwardTable.from_forward_spec(self.forwards)
+        self.assertEqual((list(table.protos), list(table.states)), ([1, 0], [1, 0]))
+        self.assertEqual(table[0].name.unescaped, "web server")
+        self.assertEqual(str(table), self.forwards)
+        self.assertEqual(str(ddwrt_forwards(self.forwards)), self.forwards)
+        self.assertEqual(str(ForwardTable.from_forwards(ddwrt_forwards(self.forwards))), self.forwards)
+        with self.assertRaises(ValueError):
+            ForwardTable.from_forward_spec("bad:maybe:tcp:80>192.168.1.10:8080")
+        for from_port, to_port in ((70000, 80), (80, -1)):
+            with self.assertRaises(ValueError):
+                table.append_escaped("bad", "on", "tcp", from_port, "192.168.1.10", to_port)
+        self.assertEqual(str(table), self.forwards)
+
+    def test_name(self):
+        name = Name("a b")
+        self.assertEqual(name.escaped, "a&nbsp;b")
+        name.unescaped = "c:d"
+        self.assertEqual(str(name), "c&semi;d")
+        name.escaped = "e&lt;f"
+        self.assertEqual((name.unescaped, name.escaped), ("e<f", "e&lt;f"))
+        self.assertEqual(ForwardTable.from_forward_spec(self.forwards).unescaped_names(), ["web server", "dns"])
+
+    def test_forward_conflicts(self):
+        forwards = ddwrt_forwards(self.forwards)
+        self.assertIs(forwards.find_by_port("udp", 53), forwards.find_by_name("dns"))
+        self.assertIsNone(forwards.find_by_port("udp", 80))
+        with self.assertRaises(ValueError):
+            forwards.add(PortForward("other", "on", "udp", 53, "192.168.1.3", 53))
+        forwards.add(PortForward("web udp", "on", "udp", 80, "192.168.1.3", 80))
+        forwards.forwards += [PortForward("web", "on", "both", 80, "192.168.1.3", 80),
+                              PortForward("dns", "on", "tcp", 53, "192.168.1.3", 5353)]
+        conflicts = forwards.validate()
+        self.assertEqual([(conflict.kind, str(conflict.forward.name), str(conflict.existing.name)) 
+                          for conflict in conflicts], 
+                         [('port', 'web', 'web&nbsp;server'), ('port', 'web', 'web&nbsp;udp'), ('name', 'dns', 'dns')])
+        forwards.remove(forwards.find_by_name("web udp"))
+        self.assertEqual(forwards.find_by_port("udp", 80).name.unescaped, "web")
+        forwards.remove(forwards.find_by_name("dns"))
+        self.assertEqual(str(forwards.find_by_name("dns").to_ip), "192.168.1.3")
+
+        forwards = ddwrt_forwards("first:on:tcp:80>192.168.1.10:80 second:on:tcp:80>192.168.1.11:80")
+        forwards.remove(forwards.find_by_name("first"))
+        self.assertIs(forwards.find_by_port("tcp", 80), forwards.find_by_name("second"))
+        with self.assertRaises(ValueError):
+            forwards.add(PortForward("third", "on", "tcp", 80, "192.168.1.12", 80))
+
+from network_common import Port, Protocol, MAC_address, State, httpd_filter_name, httpd_filter_names
+from network_common import parse_macs, format_macs, parse_ipv4s, format_ipv4s
 class NetCommonTests(unittest.TestCase):
     def test_Port(self):
         with self.assertRaises(ValueError):
@@ -78,6 +409,16 @@ class NetCommonTests(unittest.TestCase):
         with self.assertRaises(ValueError):
             MAC_address(0.0)
 
+    def test_bulk_addresses(self):
+        macs = parse_macs(["00:22:33:00:76:99", "aa:bb:cc:dd:ee:ff", "1:2"])
+        self.assertEqual(list(macs), [0x002233007699, 0xAABBCCDDEEFF, 0x12])
+        self.assertEqual(format_macs(macs), ["00:22:33:00:76:99", "AA:BB:CC:DD:EE:FF", "00:00:00:00:00:12"])
+        ips = parse_ipv4s(["192.168.1.1", "10.0.0.255"])
+        self.assertEqual(list(ips), [0xC0A80101, 0x0A0000FF])
+        self.assertEqual(format_ipv4s(ips), ["192.168.1.1", "10.0.0.255"])
+        with self.assertRaises(ValueError):
+            parse_ipv4s(["10.0.0"])
+
     def test_State(self):
         self.assertEqual((State(True).state, State("oN").state, State(1).state), (True, True, True))
         self.assertEqual((State(False).state, State("oFf").state, State(0).state), (False, False, False))
@@ -88,6 +429,409 @@ class NetCommonTests(unittest.TestCase):
         self.assertEqual(httpd_filter_name(httpd_filter_name(chars), True), chars)
         for char in chars:
             self.assertEqual(httpd_filter_name(chars).find(char), -1)
+        self.assertEqual(httpd_filter_name("&amp;nbsp;&lt;gt;&&semi;"), "&amp;nbsp;&lt;gt;&&semi;")
+        self.assertEqual(httpd_filter_name("&amp;nbsp;&lt;gt;&&semi;", True), "&amp;nbsp;<gt;&:")
+        self.assertEqual(httpd_filter_names(["a b", "c:d"]), ["a&nbsp;b", "c&semi;d"])
+        self.assertEqual(httpd_filter_names(["a&nbsp;b", "c&semi;d"], True), ["a b", "c:d"])
+
+from nvram import NVRAM_Conflict, NVRAM_ConflictError, NVRAM_PartialApply
+from fleet import Fleet
+class SimulatedNVRAMTests(NVRAMTests):
+    """Runs `NVRAMTests` against a `SimulatedRouter` instead of a real one"""
+    def connect(self):
+        self.router = SimulatedRouter({'lan_ipaddr': '192.168.1.1', 'key2': 'value2'})
+        return self.router.client()
+
+class SimulatorTests(unittest.TestCase):
+    def setUp(self):
+        self.router = SimulatedRouter({'lan_ipaddr': '192.168.1.1', 'wan_proto': 'dhcp'})
+    
+    def test_shell(self):
+        router = ddwrt_ssh(self.router.client())
+        self.assertEqual(tuple(router.run("nvram get wan_proto && echo 'a  b' | cat; status=$?; exit $status")),
+                         (b'dhcp\na  b\n', b'', 0))
+        self.assertEqual(router.run("cat /tmp/missing || printf '%s %d\\n' done $?").stdout, b'done 1\n')
+        self.assertEqual(router.run("nvram set 'a=b=c' && nvram get a").stdout, b'b=c\n')
+        self.assertEqual(router.run("ifconfig").status, 127)
+    
+    def test_fallbacks(self):
+        router = SimulatedRouter({'key': 'value'}, hostname = 'old', unsupported = ['md5sum'])
+        ddwrt_ssh.transfer_methods[('old', 22)] = 'pty'
+        self.addCleanup(ddwrt_ssh.transfer_methods.pop, ('old', 22), None)
+        nvram = NVRAM(ddwrt_ssh(router.client()))
+        self.assertEqual(nvram.get_all(), {b'key': b'value'})
+        fingerprints = NVRAM_Fingerprints()
+        self.assertIsNone(fingerprints.remote_fingerprint(nvram))
+        self.assertTrue(fingerprints.poll('old', nvram)[1])
+        self.assertFalse(fingerprints.poll('old', nvram)[1])
+
+    def test_transfer_method(self):
+        for hostname, unsupported, method in (('probed', (), 'exec'), ('no-cat', ['cat'], 'pty')):
+            self.addCleanup(ddwrt_ssh.transfer_methods.pop, (hostname, 22), None)
+            router = SimulatedRouter({'key': 'value'}, hostname = hostname, unsupported = unsupported)
+            self.assertEqual(ddwrt_ssh(router.client()).transfer_method(), method)
+            self.assertEqual(router.commands[0], 'cat')
+
+        nvram = NVRAM(ddwrt_ssh(router.client()))
+        self.assertEqual(nvram.get_all(), {b'key': b'value'})
+        with self.assertRaises(IOError):
+            nvram.restore({b'key': b'other'})
+        self.assertEqual(router.nvram, {b'key': b'value'})
+        router.unsupported.add('nvram')
+        with self.assertRaises(CommandError):
+            nvram.backup()
+
+        router = ddwrt_ssh(SimulatedRouter(hostname = 'glitch').client())
+        def probe_binary():
+            raise socket.timeout()
+        router.probe_binary = probe_binary
+        self.assertEqual(router.transfer_method(), 'pty')
+        self.assertNotIn(('glitch', 22), ddwrt_ssh.transfer_methods)
+
+    def test_round_trips(self):
+        nvram = NVRAM(ddwrt_ssh(self.router.client(), persistent_shell = True))
+        nvram.get('lan_ipaddr')
+        start = self.router.round_trips
+        nvram.push_changeset({'key{}'.format(index): 'value' for index in range(10)}, ['wan_proto'])
+        self.assertEqual(self.router.round_trips - start, 1)
+        self.assertEqual(self.router.nvram[b'key9'], b'value')
+        self.assertNotIn(b'wan_proto', self.router.nvram)
+
+    def test_push_changeset_partial(self):
+        router = SimulatedRouter({'key': 'value'})
+        router.nvram_size = 30
+        nvram = NVRAM(ddwrt_ssh(router.client()), NVRAM_ReadCache())
+        self.assertEqual(nvram.get_many(['a', 'b']), {'a': b'', 'b': b''})
+        with self.assertRaises(NVRAM_PartialApply) as raised:
+            nvram.push_changeset(OrderedDict([('b', 'far too long to fit'), ('a', '1')]), [])
+        self.assertEqual(raised.exception.applied, 0)
+        self.assertIn('no space left', str(raised.exception))
+        self.assertNotIn(b'b', router.nvram)
+        self.assertEqual(nvram.read_cache.keys(), [])
+
+        nvram.max_command_length = 130
+        with self.assertRaises(NVRAM_PartialApply) as raised:
+            nvram.push_changeset(OrderedDict([('a', '1'), ('b', 'far too long to fit'), ('c', '2')]), [])
+        self.assertEqual(raised.exception.applied, 1)
+        self.assertEqual(router.nvram, {b'key': b'value', b'a': b'1'})
+        del router.nvram[b'a']
+        del nvram.max_command_length
+
+        nvram.enter_cache_mode()
+        nvram.set('a', '1')
+        nvram.set('b', 'far too long to fit')
+        with self.assertRaises(NVRAM_PartialApply) as raised:
+            nvram.exit_cache_mode()
+        self.assertEqual(raised.exception.applied, 1)
+        self.assertEqual(router.nvram, {b'key': b'value', b'a': b'1'})
+
+    def test_sync_invalid_key(self):
+        nvram = NVRAM(ddwrt_ssh(self.router.client()))
+        start = len(self.router.commands)
+        with self.assertRaises(KeyError):
+            nvram.sync({'a=b': 'c'})
+        with self.assertRaises(KeyError):
+            nvram.push_changeset({b'a=b': b'c'}, [])
+        nvram.enter_cache_mode()
+        with self.assertRaises(KeyError):
+            nvram.sync({'a=b': 'c'})
+        self.assertEqual(nvram.cache.get_changes(), ({}, []))
+        self.assertNotIn(b'a', self.router.nvram)
+        self.assertFalse(any('nvram set' in command for command in self.router.commands[start:]))
+
+    def test_get_many_batches(self):
+        nvram = NVRAM(ddwrt_ssh(self.router.client()))
+        nvram.max_command_length = 256
+        self.router.nvram.update(('key{}'.format(index).encode(), b'value\n') for index in range(50))
+        keys = ['key{}'.format(index) for index in range(50)] + ['missing']
+        start = len(self.router.commands)
+        values = nvram.get_many(keys)
+        self.assertEqual(values, dict({key: b'value\n' for key in keys[:-1]}, missing = b''))
+        commands = self.router.commands[start:]
+        self.assertGreater(len(commands), 1)
+        self.assertTrue(all(len(command) <= 256 for command in commands))
+
+    def test_shell_timeout(self):
+        router = ddwrt_ssh(self.router.client(), persistent_shell = True)
+        channel = router.shell.channel
+        def recv(size):
+            raise socket.timeout()
+        channel.recv = recv
+        with self.assertRaises(socket.timeout):
+            router.run("nvram get lan_ipaddr", timeout = 1)
+        self.assertIsNone(router.shell)
+        self.assertTrue(channel.closed)
+        self.assertEqual(router.run("nvram get wan_proto").stdout, b'dhcp\n')
+
+    def test_compare_and_swap(self):
+        nvram = NVRAM(ddwrt_ssh(self.router.client()))
+        nvram.enter_cache_mode()
+        nvram.set('lan_ipaddr', '10.0.0.1')
+        nvram.unset('wan_proto')
+        nvram.set('new', '')
+        self.assertEqual(nvram.cache.get_bases(), {b'lan_ipaddr': b'192.168.1.1', b'wan_proto': b'dhcp', b'new': None})
+        nvram.exit_cache_mode(compare_and_swap = True, commit = True)
+        self.assertEqual(self.router.committed, {b'lan_ipaddr': b'10.0.0.1', b'new': b''})
+        nvram.enter_cache_mode()
+        nvram.set('lan_ipaddr', '10.0.0.2')
+        nvram.set('wan_proto', 'static')
+        nvram.set('new', 'value')
+        self.router.nvram[b'lan_ipaddr'] = b'10.0.0.3'
+        self.router.nvram[b'wan_proto'] = b'pppoe'
+        with self.assertRaises(NVRAM_ConflictError) as raised:
+            nvram.exit_cache_mode(compare_and_swap = True)
+        self.assertEqual(raised.exception.conflicts, [NVRAM_Conflict(b'lan_ipaddr', b'10.0.0.1', b'10.0.0.3'),
+                                                      NVRAM_Conflict(b'wan_proto', None, b'pppoe')])
+        self.assertEqual(self.router.nvram[b'new'], b'')
+        self.assertTrue(nvram.cache_mode)
+        nvram.discard_cache_mode()
+        self.assertFalse(nvram.cache_mode)
+    
+    def test_compare_and_swap_edges(self):
+        nvram = NVRAM(ddwrt_ssh(self.router.client()))
+        nvram.max_command_length = 256
+        nvram.enter_cache_mode()
+        for index in range(50):
+            nvram.set('key{}'.format(index), 'value')
+        nvram.exit_cache_mode(compare_and_swap = True)
+        self.assertEqual(self.router.nvram[b'key49'], b'value')
+        self.assertTrue(any(command.startswith('cat > ') for command in self.router.commands))
+        self.router.nvram[b'uncommitted'] = b'1'
+        nvram.enter_cache_mode()
+        nvram.exit_cache_mode(compare_and_swap = True, commit = True)
+        self.assertEqual(self.router.committed[b'uncommitted'], b'1')
+        router = SimulatedRouter({'key': 'value'}, unsupported = ['md5sum'])
+        nvram = NVRAM(ddwrt_ssh(router.client()))
+        nvram.enter_cache_mode()
+        nvram.set('key', 'other')
+        with self.assertRaises(IOError) as raised:
+            nvram.exit_cache_mode(compare_and_swap = True)
+        self.assertIn('md5sum', str(raised.exception))
+        self.assertEqual(router.nvram[b'key'], b'value')
+
+        router = SimulatedRouter({'key': 'value'})
+        router.nvram_size = 30
+        nvram = NVRAM(ddwrt_ssh(router.client()), NVRAM_ReadCache())
+        self.assertEqual(nvram.get('a'), b'')
+        with self.assertRaises(NVRAM_PartialApply) as raised:
+            nvram.apply_if_unchanged(OrderedDict([('a', '1'), ('b', 'too long to fit')]), [], {'key': 'value'})
+        self.assertEqual(raised.exception.applied, 1)
+        self.assertIn('no space left', str(raised.exception))
+        self.assertEqual(router.nvram, {b'key': b'value', b'a': b'1'})
+        self.assertEqual(nvram.get('a'), b'1')
+
+        nvram.set_command = lambda key, value: "echo noise && " + NVRAM.set_command(nvram, key, value)
+        self.assertEqual(nvram.apply_if_unchanged({'a': '2'}, [], {'a': '1'}, commit = True), [])
+        self.assertEqual(router.committed[b'a'], b'2')
+    
+    def test_exit_cache_mode(self):
+        nvram = NVRAM(ddwrt_ssh(self.router.client()))
+        nvram.enter_cache_mode()
+        nvram.set('lan_ipaddr', '10.0.0.1')
+        self.router.nvram[b'wan_proto'] = b'static'
+        nvram.exit_cache_mode()
+        self.assertEqual(self.router.nvram, {b'lan_ipaddr': b'10.0.0.1', b'wan_proto': b'static'})
+        self.assertFalse(any('restore' in command for command in self.router.commands))
+
+        snapshot = nvram.get_snapshot()
+        sets = OrderedDict([(b'lan_ipaddr', b'10.0.0.2'), (b'new', b'x' * 40)])
+        image = NVRAM_Codec().encode(sets)
+        changeset_size = sum(len(nvram.set_command(key, value)) + 2 for key, value in sets.items())
+        changeset_size += len(nvram.unset_command(b'wan_proto')) + 2
+        nvram.restore_ratio = changeset_size / len(image)
+        self.assertTrue(nvram.prefer_restore(sets, [b'wan_proto'], snapshot))
+        nvram.restore_ratio = changeset_size / (len(image) - 1)
+        self.assertFalse(nvram.prefer_restore(sets, [b'wan_proto'], snapshot))
+
+        nvram.restore_ratio = 0
+        nvram.enter_cache_mode()
+        nvram.set('lan_ipaddr', '10.0.0.3')
+        nvram.exit_cache_mode(as_changeset = None)
+        self.assertTrue(any('restore' in command for command in self.router.commands))
+        self.assertEqual(self.router.nvram[b'lan_ipaddr'], b'10.0.0.3')
+
+    def test_fingerprint_and_fleet(self):
+        fingerprints = NVRAM_Fingerprints()
+        nvram = NVRAM(ddwrt_ssh(self.router.client()))
+        self.assertTrue(fingerprints.poll('router', nvram)[1])
+        self.assertFalse(fingerprints.poll('router', nvram)[1])
+        routers = {host: SimulatedRouter({'wan_proto': 'dhcp'}, hostname = host) for host in ('a', 'b')}
+        fleet = Fleet(list(routers), connect = lambda host: ddwrt_ssh(routers[host].client()))
+        results = fleet.run_all(lambda host, nvram: nvram.sync({'wan_proto': 'static'}))
+        self.assertTrue(all(result.ok for result in results.values()))
+        self.assertEqual([router.nvram[b'wan_proto'] for router in routers.values()], [b'static', b'static'])
+
+import time
+def connect_simulated(host):
+    return ddwrt_ssh(SimulatedRouter({'k': 'v'}, hostname = host).client())
+
+class SleepJob():
+    def __init__(self, seconds):
+        self.seconds = seconds
+    
+    def __call__(self, host, nvram):
+        time.sleep(self.seconds)
+        return nvram.get('k')
+
+class FleetTests(unittest.TestCase):
+    def test_retries(self):
+        attempts = []
+        def flaky(host, nvram):
+            attempts.append(host)
+            if attempts.count(host) < 2:
+                raise IOError("flaky")
+            return nvram.get('k')
+        results = Fleet(['a', 'b'], connect = connect_simulated, retries = 1, backoff = 0.01).run_all(flaky)
+        self.assertEqual({host: (result.value, result.attempts) for host, result in results.items()},
+                         {'a': (b'v', 2), 'b': (b'v', 2)})
+    
+    def test_timeout_stops_retries(self):
+        router = SimulatedRouter({'k': 'v'})
+        def job(host, nvram):
+            if nvram.get('k') == b'v':
+                nvram.set('k', 'failed')
+                raise IOError("first attempt")
+            nvram.set('k', 'pushed')
+        fleet = Fleet(['a'], connect = lambda host: ddwrt_ssh(router.client()), timeout = 0.3, 
+                      retries = 2, backoff = 0.6)
+        start = time.time()
+        result = fleet.run_all(job)['a']
+        self.assertIsInstance(result.error, TimeoutError)
+        self.assertLess(time.time() - start, 0.6)
+        time.sleep(0.8)
+        self.assertEqual(router.nvram[b'k'], b'failed')
+    
+    def test_queue_time(self):
+        for processes in (False, True):
+            fleet = Fleet(['a', 'b', 'c', 'd'], connect = connect_simulated, parallelism = 1,
+                          timeout = 0.6, processes = processes)
+            results = fleet.run_all(SleepJob(0.2))
+            self.assertEqual({host: result.value for host, result in results.items()},
+                             {'a': b'v', 'b': b'v', 'c': b'v', 'd': b'v'})
+    
+    def test_process_timeout(self):
+        start = time.time()
+        fleet = Fleet(['a'], connect = connect_simulated, timeout = 0.3, processes = True)
+        result = fleet.run_all(SleepJob(1.5))['a']
+        self.assertIsInstance(result.error, TimeoutError)
+        self.assertLess(time.time() - start, 1.2)
+
+import asyncio
+import threading
+from async_nvram import async_ddwrt_ssh, AsyncNVRAM
+class AsyncTests(unittest.TestCase):
+    def setUp(self):
+        self.router = SimulatedRouter({'lan_ipaddr': '192.168.1.1', 'wan_proto': 'dhcp'}, latency = 0.005)
+        self.executor = ThreadPoolExecutor(8)
+        self.addCleanup(self.executor.shutdown)
+
+    def test_concurrent(self):
+        async def main():
+            nvram = AsyncNVRAM(async_ddwrt_ssh(ddwrt_ssh(self.router.client()), executor = self.executor))
+            await asyncio.gather(*[nvram.set('key{}'.format(index), index) for index in range(6)])
+            return await asyncio.gather(*[nvram.get('key{}'.format(index)) for index in range(6)])
+        self.assertEqual(asyncio.run(main()), [str(index).encode() for index in range(6)])
+
+    def test_cache_mode(self):
+        async def main():
+            nvram = AsyncNVRAM(async_ddwrt_ssh(ddwrt_ssh(self.router.client()), executor = self.executor))
+            await nvram.enter_cache_mode()
+            start = self.router.round_trips
+            await nvram.set('lan_ipaddr', '10.0.0.1')
+            await nvram.unset('wan_proto')
+            self.assertEqual(await nvram.get('lan_ipaddr'), b'10.0.0.1')
+            self.assertEqual(self.router.round_trips, start)
+            await nvram.exit_cache_mode(compare_and_swap = True)
+            self.assertFalse(nvram.cache_mode)
+        asyncio.run(main())
+        self.assertEqual(self.router.nvram, {b'lan_ipaddr': b'10.0.0.1'})
+
+    def test_limit(self):
+        lock = threading.Lock()
+        in_flight = [0, 0]
+        def work():
+            with lock:
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight)
+            time.sleep(0.02)
+            with lock:
+                in_flight[0] -= 1
+        async def main():
+            router = async_ddwrt_ssh(ddwrt_ssh(self.router.client()), max_concurrent = 2, executor = self.executor)
+            await asyncio.gather(*[router.call(work) for index in range(6)])
+        asyncio.run(main())
+        self.assertEqual(in_flight[1], 2)
+
+from metrics import AggregateSink, CallbackSink
+class MetricsTests(unittest.TestCase):
+    def test_aggregate(self):
+        sink = AggregateSink()
+        self.addCleanup(ddwrt_ssh.transfer_methods.pop, ('metrics', 22), None)
+        router = ddwrt_ssh(SimulatedRouter({'key': 'value'}, hostname = 'metrics').client())
+        router.metrics = sink
+        nvram = NVRAM(router)
+        nvram.metrics = sink
+        self.assertEqual(nvram.get('key'), b'value')
+        nvram.backup()
+        with self.assertRaises(IOError):
+            router.run("false", check = True)
+        summary = sink.summary()
+        self.assertEqual(summary['nvram.get']['count'], 1)
+        self.assertEqual(summary['nvram.get']['bytes_in'], 5)
+        self.assertEqual(summary['ssh.run']['count'], 2)
+        self.assertEqual(summary['ssh.run']['errors'], 1)
+        self.assertGreater(summary['ssh.iter_raw']['bytes_in'], 0)
+        self.assertEqual(summary['nvram.backup']['bytes_in'], summary['ssh.iter_raw']['bytes_in'])
+        exposition = sink.prometheus()
+        self.assertIn('ddwrt_seconds_count{event="nvram.get"} 1\n', exposition)
+        families = exposition.split('# TYPE ')[1:]
+        self.assertEqual(len(families), 4)
+        for family in families:
+            name = family.split(' ')[0]
+            self.assertTrue(all(line.startswith(name) for line in family.splitlines()[1:]))
+        self.assertIn('ddwrt.nvram.get.count:1|c\n', sink.statsd())
+        self.assertNotIn('ddwrt.nvram.get.', sink.statsd())
+        nvram.get('key')
+        self.assertIn('ddwrt.nvram.get.count:1|c\n', sink.statsd())
+
+    def test_callback(self):
+        events = []
+        NVRAM_Codec.metrics = CallbackSink(lambda *event: events.append(event))
+        try:
+            NVRAM_Codec().decode(make_backup([(b'a', b'b')]))
+        finally:
+            NVRAM_Codec.metrics = None
+        self.assertEqual([event[0] for event in events], ['codec.decode'])
+
+    def test_keywords(self):
+        events = []
+        def broken(*event):
+            raise RuntimeError("the sink is down")
+        backup = make_backup([(b'a', b'b')])
+        NVRAM_Codec.metrics = CallbackSink(lambda *event: events.append(event))
+        try:
+            self.assertEqual(NVRAM_Codec().decode(data = backup, ordered = False), {b'a': b'b'})
+            NVRAM_Codec.metrics = CallbackSink(broken)
+            self.assertEqual(NVRAM_Codec().decode(backup), {b'a': b'b'})
+        finally:
+            NVRAM_Codec.metrics = None
+        self.assertEqual([(event[0], event[2]) for event in events], [('codec.decode', len(backup))])
+
+import benchmarks
+class BenchmarkTests(unittest.TestCase):
+    def test_run(self):
+        results = benchmarks.run_benchmarks(sizes = (64, ), router_size = 64, latency = 0, repeat = 1)
+        self.assertIn('codec.decode[64]', results)
+        self.assertIn('nvram.cache_mode[shell]', results)
+    
+    def test_default_sizes(self):
+        for name, func in benchmarks.codec_cases(benchmarks.default_sizes):
+            func()
+    
+    def test_compare(self):
+        baseline = {'a': {'best': 1.0}, 'b': {'best': 1.0}, 'c': {'best': 1.0}}
+        results = {'a': {'best': 1.1}, 'b': {'best': 1.5}, 'd': {'best': 9.0}}
+        self.assertEqual(benchmarks.compare_results(results, baseline, 0.2), [('b', 1.0, 1.5, 1.5)])
 
 if __name__ == '__main__':
     unittest.main()